@@ -0,0 +1,636 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+     this script measures parts of check_url.py with synthetic data.
+     usage: benchmark.py test [options]
+      tests are:
+
+      exclude [pattern_count] [url_count]
+          it compares the exclude matcher (ExcludeMatcher) with the
+          former loop that calls url.find() for every exclude string.
+
+      csv [line_count] [parse_csv]
+          it compares the ALMA CSV reader of check_url.py (input_format=
+          alma_csv) with the shell pipeline of checkurl_bib_portolio.sh:
+          parse_csv, sed and sort -u. parse_csv is the compiled program
+          (default ./parse_csv); the pipeline is skipped without it.
+
+      report [failure_count]
+          it collates failure_count failed URLs (default 100000), and
+          fractions of them, with the report aggregator (ReportAggregator)
+          and with the former per-error string lists, to show how each
+          one grows with the number of failures.
+
+      engines [line_count] [latency] [engines] [config entries...]
+          it runs check_url.py on line_count synthetic URL lines (default
+          10000) against a local HTTP server and reports URLs per second,
+          the latency of the URLs measured by check_url.py (p50/p99, see
+          result_latencies), the peak RSS of the processes and their CPU
+          time, for each engine of
+          engines (default multiprocess,async; also streaming, the async
+          engine with streaming=yes).
+          the server answers 200, 301, 302, 403, 404 and 500, hangs past
+          the timeout, resets connections and imitates the PURL -> EZproxy
+          redirect of pid.emory.edu, on 16 loopback hosts. latency is the
+          distribution of its answer times in ms: const:ms, uniform:min:max,
+          exp:mean or lognormal:median:sigma (default lognormal:50:0.8).
+          config entries (e.g. process_count=12 timer=5) are added to the
+          configuration of check_url.py.
+
+      memory [line_count] [partition_lines] [input_formats]
+          it reads line_count synthetic URL lines (default 1000000), and
+          fractions of them, through the stages of check_url.py that see
+          the whole input: dedupe, one result per line and collation of
+          the failed ones (1% of the URLs). it reports the peak RSS of the in-memory
+          dedupe (dedupe_urls) and of the large-input mode
+          (PartitionDedupe, one partition per partition_lines lines,
+          default 200000), to show how each one grows with the input.
+          input_formats are the formats of the input (default
+          text,alma_csv; the CSV input also goes through alma_csv_lines).
+"""
+
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import check_url
+
+
+def synthetic_exclusion(pattern_count):
+    """
+      it returns pattern_count exclude strings like the ones of the
+      exclude file: proxy prefixes and cgi-bin directories.
+    """
+    exclusion=[]
+    for k in range(pattern_count):
+        if k % 2 == 0:
+            exclusion.append("https://proxy"+str(k)+".library.example.edu/login?url=")
+        else:
+            exclusion.append("http://host"+str(k)+".example.edu/cgi-bin/")
+    return exclusion
+
+def synthetic_urls(url_count,pattern_count):
+    """
+      it returns url_count URLs; about one in ten contains an exclude
+      string.
+    """
+    urls=[]
+    for k in range(url_count):
+        host=random.randint(0,2*pattern_count)
+        if k % 10 == 0:
+            urls.append("http://host"+str(host | 1)+".example.edu/cgi-bin/record?id="+str(k))
+        else:
+            urls.append("https://www.vendor"+str(host)+".com/stable/"+str(k)+"?accountid=14522")
+    return urls
+
+def exclude_loop(urls,exclusion):
+    """
+      the former exclusion test of process_file.
+    """
+    kept=0
+    for url in urls:
+        skip_it=False
+        for x_string in exclusion:
+            if url.find(x_string) > -1:
+                skip_it=True
+                break
+        if not skip_it:
+            kept+=1
+    return kept
+
+def exclude_matcher(urls,matcher):
+    kept=0
+    for url in urls:
+        if not matcher.matches(url):
+            kept+=1
+    return kept
+
+def bench_exclude(argv):
+    pattern_count=int(argv[0]) if len(argv) > 0 else 5000
+    url_count=int(argv[1]) if len(argv) > 1 else 5000
+    random.seed(18)
+    exclusion=synthetic_exclusion(pattern_count)
+    urls=synthetic_urls(url_count,pattern_count)
+
+    start=time.time()
+    matcher=check_url.ExcludeMatcher(exclusion)
+    build_time=time.time()-start
+
+    start=time.time()
+    kept_loop=exclude_loop(urls,exclusion)
+    loop_time=time.time()-start
+
+    start=time.time()
+    kept_matcher=exclude_matcher(urls,matcher)
+    matcher_time=time.time()-start
+
+    if kept_loop != kept_matcher:
+        sys.stderr.write("**ERR: the matcher and the loop disagree\n")
+        return 1
+    print("exclude strings: "+str(pattern_count)+" URLs: "+str(url_count)+" kept: "+str(kept_loop))
+    print("url.find loop:   "+'{:.3f}'.format(loop_time)+" s ("+
+          '{:.1f}'.format(loop_time*1e6/url_count)+" us per URL)")
+    print("ExcludeMatcher:  "+'{:.3f}'.format(matcher_time)+" s ("+
+          '{:.1f}'.format(matcher_time*1e6/url_count)+" us per URL), built in "+
+          '{:.3f}'.format(build_time)+" s")
+    return 0
+def synthetic_alma_csv(csv_f,line_count):
+    """
+      it writes an ALMA CSV export of line_count lines to csv_f: about a
+      third of the URLs are shared by several records, one line in ten
+      is repeated and some fields are quoted.
+    """
+    csv_f.write("Resource Type,MMS Id,URL\n")
+    for k in range(line_count):
+        if k % 10 == 9:
+            k=k-random.randint(1,9)
+        mms_id=str(990000000000302486+k)
+        if k % 3 == 0:
+            url="http://purl.access.gpo.gov/GPO/LPS"+str(k % 1000)
+        else:
+            url="https://www.vendor"+str(k % 500)+".com/stable/"+str(k)+"?accountid=14522"
+        if k % 2 == 0:
+            csv_f.write("Bibliographic Record,"+mms_id+","+url+"\n")
+        else:
+            csv_f.write('"Portfolio","'+mms_id+'","'+url+'"\n')
+    return
+
+def bench_csv(argv):
+    line_count=int(argv[0]) if len(argv) > 0 else 200000
+    parse_csv=argv[1] if len(argv) > 1 else "./parse_csv"
+    random.seed(18)
+    work_dir=tempfile.mkdtemp()
+    csv_file=os.path.join(work_dir,"alma.csv")
+    csv_f=open(csv_file,"w")
+    synthetic_alma_csv(csv_f,line_count)
+    csv_f.close()
+
+    start=time.time()
+    first_time=None
+    native_lines=set()
+    csv_f=open(csv_file,"r",newline="")
+    for i_line in check_url.alma_csv_lines(csv_f):
+        if first_time is None:
+            first_time=time.time()-start
+        native_lines.add(i_line)
+    csv_f.close()
+    native_time=time.time()-start
+    print("CSV lines: "+str(line_count)+" distinct lines: "+str(len(native_lines)))
+    print("alma_csv_lines: "+'{:.3f}'.format(native_time)+" s, first line after "+
+          '{:.4f}'.format(first_time)+" s")
+
+    if not os.access(parse_csv,os.X_OK):
+        sys.stderr.write("parse_csv not found ("+parse_csv+"); shell pipeline skipped\n")
+        return 0
+    # the script writes "\\|", which GNU sed reads as an alternation; a
+    # plain "|" is literal for both GNU and BSD sed.
+    pipeline=("cat "+csv_file+" | "+parse_csv+" -d\",\" |"
+              " sed 's/\\(.*\\)_|_\\(.*\\)_|_\\(.*\\)/\\3_|_\\2_|_\\1/g' |"
+              " sed 's/Bibliographic Record/1/g' | sed 's/Portfolio/2/g' | sort -u")
+    start=time.time()
+    first_time=None
+    shell_lines=set()
+    proc=subprocess.Popen(pipeline,shell=True,stdout=subprocess.PIPE,universal_newlines=True)
+    for i_line in proc.stdout:
+        if first_time is None:
+            first_time=time.time()-start
+        shell_lines.add(i_line.rstrip("\n"))
+    proc.wait()
+    shell_time=time.time()-start
+    print("shell pipeline: "+'{:.3f}'.format(shell_time)+" s, first line after "+
+          '{:.4f}'.format(first_time)+" s")
+    # parse_csv keeps the quotes of a quoted first field, so those lines
+    # (and the header line) are not converted by the pipeline.
+    print("lines that differ: "+str(len(native_lines ^ shell_lines)))
+    return 0
+def synthetic_records(failure_count):
+    """
+      it returns failure_count result records of failed URLs (see
+      check_url.result_record).
+    """
+    codes=["404","404","403","500","603","610","400","401","607"]
+    records=[]
+    for k in range(failure_count):
+        url="https://www.vendor"+str(k % 500)+".com/stable/"+str(k)+"?accountid=14522"
+        i_line=url+"_|_"+str(990000000000302486+k)+"_|_"+str(1+k % 2)
+        records.append(check_url.result_record(codes[k % len(codes)],"",i_line,"",
+                                               (0.25,1024,None,1528000000+k)))
+    return records
+
+def report_lists(records):
+    """
+      the former collation: one list of email bodies per error type,
+      grown with +=, and list.index() to find the resource type.
+    """
+    lists={}
+    for code in ["404","403","500","603","610","400","401","607"]:
+        lists[code]=["","",""]
+    for record in records:
+        lists[record["status"]][record["resource_type"]]+=record["url"]+" mms_id: "+record["mms_id"]+"\n"
+    size=0
+    for code in lists:
+        for entry in lists[code]:
+            rtype_id=lists[code].index(entry)
+            size+=len(entry)
+    return size
+
+def report_aggregator(records):
+    aggregator=check_url.ReportAggregator(tempfile.gettempdir())
+    for record in records:
+        aggregator.add(record)
+    size=0
+    for category,resource_type,body in aggregator.bodies():
+        size+=len(body)
+    aggregator.close()
+    return size
+
+def bench_report(argv):
+    failure_count=int(argv[0]) if len(argv) > 0 else 100000
+    records=synthetic_records(failure_count)
+    print("failures   aggregator (us per failure)   string lists (us per failure)")
+    for count in [failure_count//8,failure_count//4,failure_count//2,failure_count]:
+        start=time.time()
+        report_aggregator(records[:count])
+        aggregator_time=time.time()-start
+        start=time.time()
+        report_lists(records[:count])
+        lists_time=time.time()-start
+        print('{:8d}'.format(count)+"   "+'{:.3f}'.format(aggregator_time)+" s ("+
+              '{:.2f}'.format(aggregator_time*1e6/max(count,1))+")            "+
+              '{:.3f}'.format(lists_time)+" s ("+'{:.2f}'.format(lists_time*1e6/max(count,1))+")")
+    return 0
+
+## the answers of the benchmark server: (share of the input, path).
+server_paths=[
+    (0.62,"/s200/"),
+    (0.05,"/s301/"),
+    (0.05,"/s302/"),
+    (0.03,"/s403/"),
+    (0.08,"/s404/"),
+    (0.02,"/s500/"),
+    (0.01,"/hang/"),
+    (0.01,"/reset/"),
+    (0.13,"/pid/")
+]
+server_hosts=["127.0.0."+str(k) for k in range(1,17)]
+## the host of the PURLs (purl_hosts of check_url.py).
+purl_host="127.0.0.100"
+
+def latency_sampler(spec):
+    """
+      it returns a function that draws an answer time, in seconds, from
+      the distribution spec (see engines in the usage).
+    """
+    field=spec.split(":")
+    if field[0] == "const" and len(field) == 2:
+        return lambda: float(field[1])/1000
+    if field[0] == "uniform" and len(field) == 3:
+        return lambda: random.uniform(float(field[1]),float(field[2]))/1000
+    if field[0] == "exp" and len(field) == 2:
+        return lambda: random.expovariate(1/float(field[1]))/1000
+    if field[0] == "lognormal" and len(field) == 3:
+        return lambda: random.lognormvariate(math.log(float(field[1])),float(field[2]))/1000
+    raise ValueError("unknown latency distribution: "+spec)
+
+def server_answer(path,port,hang_time):
+    """
+      it returns (status,headers,action) for path; action is "hang",
+      "reset" or None.
+    """
+    field=path.split("/")
+    kind=field[1] if len(field) > 1 else ""
+    key=field[2] if len(field) > 2 else "0"
+    if kind == "s301" or kind == "s302":
+        return int(kind[1:]),{"Location":"/s200/"+key},None
+    if kind in ("s403","s404","s500"):
+        return int(kind[1:]),{},None
+    if kind == "hang":
+        return 200,{},"hang"
+    if kind == "reset":
+        return 200,{},"reset"
+    if kind == "pid":
+        # the PURL server sends the EZproxy login URL of the target.
+        host=server_hosts[int(key) % len(server_hosts)]
+        target="http://"+host+":"+str(port)+"/s200/"+key
+        return 302,{"Location":"http://"+host+":"+str(port)+"/login?url="+target},None
+    if kind.startswith("login?url="):
+        return 302,{"Location":path.split("?url=",1)[1]},None
+    return 200,{},None
+
+def percentile(values,fraction):
+    if len(values) == 0:
+        return 0
+    values=sorted(values)
+    return values[min(len(values)-1,int(fraction*len(values)))]
+
+def run_server(port_queue,latency,hang_time):
+    """
+      the benchmark server, an HTTP/1.1 server with keep-alive, on
+      server_hosts and purl_host. it puts its port in port_queue.
+    """
+    draw=latency_sampler(latency)
+    probe=socket.socket()
+    probe.bind((server_hosts[0],0))
+    port=probe.getsockname()[1]
+    probe.close()
+
+    async def handle(reader,writer):
+        try:
+            while True:
+                request_line=await reader.readline()
+                if not request_line:
+                    break
+                while True:
+                    line=await reader.readline()
+                    if not line or line == b"\r\n":
+                        break
+                method,path,version=request_line.decode("latin-1").split(" ",2)
+                status,headers,action=server_answer(path,port,hang_time)
+                body=b"x"*2000
+                await asyncio.sleep(draw())
+                if action == "hang":
+                    await asyncio.sleep(hang_time)
+                if action == "reset":
+                    sock=writer.get_extra_info("socket")
+                    sock.setsockopt(socket.SOL_SOCKET,socket.SO_LINGER,struct.pack("ii",1,0))
+                    writer.transport.abort()
+                    return
+                head="HTTP/1.1 "+str(status)+" X\r\nContent-Length: "+str(len(body))+"\r\n"
+                for name in headers:
+                    head+=name+": "+headers[name]+"\r\n"
+                writer.write((head+"\r\n").encode("latin-1"))
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+        except (ConnectionError,ValueError):
+            pass
+        writer.close()
+
+    async def serve():
+        server=await asyncio.start_server(handle,server_hosts+[purl_host],port,backlog=1024)
+        port_queue.put(port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+def synthetic_input(input_f,line_count,port):
+    """
+      it writes line_count URL_|_mms_id_|_type lines to input_f with the
+      mix of server_paths; one line in five repeats a URL.
+    """
+    paths=[]
+    for share,path in server_paths:
+        paths.extend([path]*int(share*100))
+    for k in range(line_count):
+        key=k if k % 5 != 4 else random.randint(0,k)
+        path=paths[key % len(paths)]
+        host=purl_host if path == "/pid/" else server_hosts[key % len(server_hosts)]
+        url="http://"+host+":"+str(port)+path+str(key)
+        input_f.write(url+"_|_"+str(990000000000302486+k)+"_|_"+str(1+k % 2)+"\n")
+    return
+
+def process_tree_rss(pid):
+    """
+      it returns the RSS, in bytes, of process pid and its descendants.
+    """
+    parents={}
+    rss={}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/"+entry+"/status") as status_f:
+                for line in status_f:
+                    if line.startswith("PPid:"):
+                        parents[int(entry)]=int(line.split()[1])
+                    elif line.startswith("VmRSS:"):
+                        rss[int(entry)]=int(line.split()[1])*1024
+        except (OSError,ValueError):
+            continue
+    tree=set([pid])
+    changed=True
+    while changed:
+        changed=False
+        for child,parent in parents.items():
+            if parent in tree and child not in tree:
+                tree.add(child)
+                changed=True
+    return sum(rss.get(member,0) for member in tree)
+
+## the configuration entries of each engine.
+engine_configs={
+    "multiprocess":["engine=multiprocess"],
+    "async":["engine=async"],
+    "streaming":["engine=async","streaming=yes"]
+}
+
+def result_latencies(results_file):
+    """
+      it returns the latencies, measured by check_url.py, of the URLs of
+      results_file that the server answered 403, 404 or 500. only failed
+      URLs get a result record; these are answered after the same
+      latency as the healthy ones, so they are a sample of the time each
+      engine takes to test a URL: connection setup and client-side
+      scheduling included, hangs and resets left out.
+    """
+    latencies=[]
+    with open(results_file,"r") as results_f:
+        for line in results_f:
+            record=json.loads(line)
+            if record["status"] in ("403","404","500") and record["latency"] is not None:
+                latencies.append(record["latency"])
+    return latencies
+
+def run_engine(engine,work_dir,input_file,port,extra):
+    """
+      it runs check_url.py with engine on input_file and returns
+      (seconds,peak RSS,CPU seconds,stderr lines); the result records
+      go to results_ENGINE.jsonl in work_dir.
+    """
+    config_file=os.path.join(work_dir,"check_url_"+engine+".cfg")
+    config_f=open(config_file,"w")
+    for line in ["process_count=8","timer=2","temp_directory="+work_dir+"/",
+                 "in_file="+work_dir+"/url_list.txt","mailing_list="+work_dir+"/mail_list.txt",
+                 "smtp_server=127.0.0.1:1","from_mail=benchmark@localhost",
+                 "dns_workers=0","purl_hosts="+purl_host,
+                 "results_file="+work_dir+"/results_"+engine+".jsonl"]+engine_configs[engine]+extra:
+        config_f.write(line+"\n")
+    config_f.close()
+    script=os.path.join(os.path.dirname(os.path.abspath(__file__)),"check_url.py")
+    usage_before=resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak=[0]
+    start=time.time()
+    input_f=open(input_file,"r")
+    proc=subprocess.Popen([sys.executable,script,config_file],stdin=input_f,
+                          stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+    def sample():
+        while proc.poll() is None:
+            peak[0]=max(peak[0],process_tree_rss(proc.pid))
+            time.sleep(0.2)
+
+    sampler=threading.Thread(target=sample)
+    sampler.start()
+    errors=proc.stderr.readlines()
+    proc.wait()
+    elapsed=time.time()-start
+    sampler.join()
+    input_f.close()
+    usage_after=resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu=(usage_after.ru_utime-usage_before.ru_utime)+(usage_after.ru_stime-usage_before.ru_stime)
+    return elapsed,peak[0],cpu,errors
+
+def bench_engines(argv):
+    line_count=int(argv[0]) if len(argv) > 0 else 10000
+    latency=argv[1] if len(argv) > 1 else "lognormal:50:0.8"
+    engines=argv[2].split(",") if len(argv) > 2 else ["multiprocess","async"]
+    extra=argv[3:]
+    latency_sampler(latency)
+    for engine in engines:
+        if engine not in engine_configs:
+            sys.stderr.write("**ERR: unknown engine "+engine+"\n")
+            return 1
+    random.seed(18)
+    work_dir=tempfile.mkdtemp()
+    port_queue=multiprocessing.Queue()
+    server=multiprocessing.Process(target=run_server,args=(port_queue,latency,4.0))
+    server.daemon=True
+    server.start()
+    port=port_queue.get(timeout=10)
+    input_file=os.path.join(work_dir,"input.txt")
+    input_f=open(input_file,"w")
+    synthetic_input(input_f,line_count,port)
+    input_f.close()
+    # no mailing list entry matches the resource types: no mail is sent.
+    mail_f=open(os.path.join(work_dir,"mail_list.txt"),"w")
+    mail_f.write("9|benchmark|nobody@localhost\n")
+    mail_f.close()
+    print("lines: "+str(line_count)+" latency: "+latency+" "+" ".join(extra))
+    print("engine          seconds   URLs/s   p50 ms   p99 ms   peak RSS MB   CPU s")
+    for engine in engines:
+        elapsed,peak,cpu,errors=run_engine(engine,work_dir,input_file,port,extra)
+        latencies=result_latencies(os.path.join(work_dir,"results_"+engine+".jsonl"))
+        tested=line_count
+        for line in errors:
+            if line.startswith("URLs tested:"):
+                tested=int(line.split()[2])
+        print('{:<14}'.format(engine)+'{:9.1f}'.format(elapsed)+'{:9.0f}'.format(tested/elapsed)+
+              '{:9.1f}'.format(percentile(latencies,0.5)*1000)+'{:9.1f}'.format(percentile(latencies,0.99)*1000)+
+              '{:14.1f}'.format(peak/1048576.0)+'{:8.1f}'.format(cpu))
+    server.terminate()
+    return 0
+
+def synthetic_lines(input_f,line_count):
+    """
+      it writes line_count URL lines to input_f, two lines per URL on
+      average, with a 5% share of PURLs.
+    """
+    url_count=max(line_count//2,1)
+    for k in range(line_count):
+        key=(k*7919) % url_count
+        if key % 20 == 0:
+            url="http://pid.emory.edu/ark:/25593/"+'{:x}'.format(key)
+        else:
+            url="https://www.vendor"+str(key % 5000)+".com/stable/"+str(key)+"?accountid=14522"
+        input_f.write(url+"_|_"+str(990000000000302486+k)+"_|_"+str(1+k % 2)+"\n")
+    return
+
+def memory_stages(input_file,input_format,work_dir,partitions):
+    """
+      the whole-input stages of a run: dedupe (in memory when partitions
+      is 0), a result for every line, a failure for one URL in 100.
+    """
+    aggregator=check_url.ReportAggregator(work_dir)
+    writer=check_url.ResultWriter(aggregator)
+    input_f=open(input_file,"r",newline="")
+    lines=input_f
+    if input_format == "alma_csv":
+        lines=check_url.alma_csv_lines(input_f,unique=partitions == 0)
+    lines=check_url.select_lines(lines,check_url.ExcludeMatcher([]))
+    if partitions > 0:
+        dedupe=check_url.PartitionDedupe(writer,work_dir+"/",partitions,input_format == "alma_csv")
+        dedupe.partition(lines)
+        items=dedupe.items()
+    else:
+        items,line_count=check_url.dedupe_urls(lines)
+    input_f.close()
+    for k,(url,lines,validators) in enumerate(items):
+        if k % 100 == 0:
+            writer.result(lines,"404","Not Found","",(0.1,512,None,1528000000))
+    for category,resource_type,body in aggregator.bodies():
+        pass
+    aggregator.close()
+
+def peak_rss(input_file,input_format,work_dir,partitions):
+    """
+      it runs memory_stages in a child process and returns (seconds,peak
+      RSS in bytes) of the child.
+    """
+    start=time.time()
+    pid=os.fork()
+    if pid == 0:
+        status=0
+        try:
+            memory_stages(input_file,input_format,work_dir,partitions)
+        except:
+            status=1
+        os._exit(status)
+    pid,status,usage=os.wait4(pid,0)
+    if status != 0:
+        sys.stderr.write("**ERR: the memory stages failed\n")
+    # ru_maxrss is in kilobytes on Linux.
+    return time.time()-start,usage.ru_maxrss*1024
+
+def bench_memory(argv):
+    line_count=int(argv[0]) if len(argv) > 0 else 1000000
+    partition_lines=int(argv[1]) if len(argv) > 1 else 200000
+    input_formats=argv[2].split(",") if len(argv) > 2 else ["text","alma_csv"]
+    work_dir=tempfile.mkdtemp()
+    input_file=os.path.join(work_dir,"input.txt")
+    for input_format in input_formats:
+        print("input_format="+input_format)
+        print("lines      in memory: s   peak RSS MB   partitions   large input: s   peak RSS MB")
+        for count in [line_count//8,line_count//4,line_count//2,line_count]:
+            input_f=open(input_file,"w")
+            if input_format == "alma_csv":
+                synthetic_alma_csv(input_f,count)
+            else:
+                synthetic_lines(input_f,count)
+            input_f.close()
+            partitions=(count+partition_lines-1)//partition_lines
+            memory_time,memory_peak=peak_rss(input_file,input_format,work_dir,0)
+            partition_time,partition_peak=peak_rss(input_file,input_format,work_dir,partitions)
+            print('{:9d}'.format(count)+'{:14.1f}'.format(memory_time)+'{:14.1f}'.format(memory_peak/1048576.0)+
+                  '{:13d}'.format(partitions)+'{:17.1f}'.format(partition_time)+
+                  '{:14.1f}'.format(partition_peak/1048576.0))
+    os.unlink(input_file)
+    os.rmdir(work_dir)
+    return 0
+
+
+benchmarks={
+    "exclude":bench_exclude,
+    "csv":bench_csv,
+    "report":bench_report,
+    "engines":bench_engines,
+    "memory":bench_memory
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        sys.stderr.write(__doc__)
+        exit(1)
+    exit(benchmarks[sys.argv[1]](sys.argv[2:]))
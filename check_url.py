@@ -8,15 +8,74 @@
 
       process_count,
       timer,
+      connect_timeout,
+      read_timeout,
+      adaptive_timeouts,
+      timeout_min,
+      timeout_max,
+      timeout_history,
       in_file,
       temp_directory,
       exclude,
       mailing_list,
       smtp_server,
-      from_mail
+      from_mail,
+      batch_size,
+      engine,
+      max_in_flight,
+      probe,
+      head_bad_hosts,
+      host_max_in_flight,
+      host_rate,
+      host_limit,
+      schedule_window,
+      cache_ttl,
+      cache_file,
+      dns_workers,
+      breaker_threshold,
+      breaker_cooldown,
+      breaker_probes,
+      pool_connections,
+      pool_maxsize,
+      keepalive_timeout,
+      streaming,
+      input_format,
+      csv_delimiter,
+      resource_type,
+      mail_digest,
+      smtp_timeout,
+      purl_hosts,
+      purl_workers,
+      purl_ttl,
+      max_redirects,
+      progress_interval,
+      metrics_file,
+      metrics_hosts,
+      summary_file,
+      journal_batch,
+      shard_directory,
+      retry_attempts,
+      retry_delay,
+      retry_budget,
+      results_file,
+      report_mode,
+      large_input,
+      partition_lines
           "process_count" is the number of concurrent processes that
           perform the HTTP requests.
           "timer" is the number of seconds allowed to the request.
+          "connect_timeout" and "read_timeout" are the seconds allowed to
+          connect and to wait for the answer (default timer).
+          "adaptive_timeouts" is "yes" to adapt the timeouts to each host
+          (default "no"): after a few answers the limit of a host is its
+          smoothed answer time plus four times its variation, as in TCP,
+          no less than "timeout_min" seconds (default 1); a timeout
+          doubles the limits of the host. the connect limit never goes
+          above connect_timeout, nor the read limit above "timeout_max"
+          (default 30), so slow hosts may get longer than timer.
+          "timeout_history" is "yes" to keep the answer times in cache_file
+          and start each host from those of the previous runs (default
+          "no").
           "in_file" is the text file that contains the URLs.
              a line in the in_file is:
              URL_|_alma_mms_id_|_resource_type
@@ -30,6 +89,138 @@
           or portfolio) 
          "smtp_server" is the hostame that mails out the results.
          "from_mail" is the email address of the sender.
+         "batch_size" is the number of URL lines that a process takes
+          from the shared work queue at a time (default 20).
+         "engine" selects how the requests are performed:
+          "multiprocess" (default) spawns process_count processes that
+          perform one blocking request at a time;
+          "async" uses a single asyncio process (it requires aiohttp).
+         "max_in_flight" is the number of concurrent requests of the
+          async engine (default 500).
+         "probe" is "get" (default) to test a URL with a GET request, or
+          "head" to send a HEAD request first; when the server rejects
+          HEAD (405 or 501) the URL gets a GET request that is closed
+          after the headers, so response bodies are never downloaded.
+         "head_bad_hosts" lists the hosts (separated by ",") that get the
+          streamed GET without a HEAD request.
+         "host_max_in_flight" is the number of concurrent requests allowed
+          per host (default 4) and "host_rate" the number of requests per
+          second per host (default 0, no limit). they apply to the host of
+          each request, redirect hops included; the requests of a URL to
+          the same host count once.
+         "host_limit" overrides them for a domain and its subdomains:
+          host_limit=domain|max_in_flight|rate (one entry per line).
+         "schedule_window" is the number of URLs that the scheduler keeps
+          grouped by host to interleave the hosts (default 10000).
+         "cache_ttl" is the number of hours during which a healthy URL is
+          not tested again (default 0, no cache). after cache_ttl the URL
+          gets a conditional request (ETag/Last-Modified); failed URLs are
+          always tested. the results are kept in "cache_file" (default
+          temp_directory/url_cache.sqlite).
+         "dns_workers" is the number of concurrent DNS lookups of the
+          pre-resolution stage that resolves every hostname once before
+          the requests (default 32; 0 turns the stage off). URLs on
+          hostnames that don't exist get 603 without a request.
+         "breaker_threshold" is the number of consecutive timeouts or
+          failed connections (603, 605, 610) after which the circuit
+          breaker of a host opens (default 0, no breaker): the remaining
+          URLs of the host get the same error type without a request and
+          are reported as inferred. after "breaker_cooldown" seconds
+          (default 120) up to "breaker_probes" requests (default 2) test
+          the host; an answer closes the breaker.
+         "pool_connections" is the number of hosts for which a worker keeps
+          a pool of open connections (default 500); "pool_maxsize" is the
+          number of kept-alive connections per host (default 4).
+         "keepalive_timeout" is the number of seconds an idle connection
+          stays open in the async engine (default 30).
+         "streaming" is "yes" to test the URLs while they are read from
+          stdin (default "no"): in_file is not written, there are no
+          result_NNNN files and the results are collated in memory as
+          they arrive. the DNS pre-resolution stage, which needs all the
+          hostnames first, is not used.
+         "input_format" is "text" (default) for lines like
+          URL_|_alma_mms_id_|_resource_type, or "alma_csv" to read the ALMA
+          CSV export (resource type,mms_id,URL) directly, without
+          parse_csv, sed and sort -u. "csv_delimiter" is its field
+          delimiter (default ","). "resource_type" maps the ALMA resource
+          type to the resource_type: resource_type=name|number (one entry
+          per line; default "Bibliographic Record|1" and "Portfolio|2").
+         "mail_digest" is "yes" to send one message per recipient group with
+          a report per attachment, or "no" (default) for one message per
+          report. all the messages go through one SMTP session;
+          "smtp_timeout" is its timeout in seconds (default 30).
+         "purl_hosts" lists the PURL servers (separated by ",") whose URLs
+          are replaced by the target of their redirect before the URLs are
+          deduplicated and tested (default pid.emory.edu; also known:
+          purl.access.gpo.gov, hdl.handle.net). "purl_workers" is the
+          number of concurrent PURL requests (default 4; 0 turns the
+          stage off). the targets are kept in cache_file for "purl_ttl"
+          hours (default 0, only for the run).
+         "max_redirects" is the number of redirects followed to test a URL
+          (default 0: a redirect is a healthy answer). a longer chain gets
+          612 and a redirect loop 613; the hops are cached for the run, so
+          a hop shared by several chains is requested once.
+         "journal_batch" is the number of results that a worker appends
+          to its journal (temp_directory/journal_NNNN) per write and fsync
+          (default 200; 0: no journal). the journal is deleted when all
+          the URLs are tested, before the reports are mailed; a run that
+          can't send all its reports exits 1. after an interrupted run,
+          "check_url.py config_file --resume" (with the same input) takes
+          the results of the journal and tests only the remaining URLs;
+          the reports hold the results of both.
+         "shard_directory" is the directory shared by the nodes of a
+          sharded run (default temp_directory). each node gets the whole
+          input and "check_url.py config_file --shard i/n" tests shard i
+          (0..n-1) of n: the URLs are partitioned by a consistent hash of
+          their hostname, so each host is tested by one node (PURLs are
+          partitioned by URL). a node keeps its work files, in_file
+          included, in temp_directory/shard_i/ and writes its failed URLs
+          to shard_directory/shard_i_of_n.txt instead of mailing them;
+          "check_url.py config_file --merge n" then collates the n shards
+          and mails the reports once.
+         "retry_attempts" is the number of times a URL with a transient
+          error (500, 503, 605 or 610) is tested again (default 0, none).
+          the first pass over the input is not held up: each worker tests
+          its URLs again at the end, "retry_delay" seconds after the
+          failure (default 30), twice as long after each new failure. the
+          run tests at most "retry_budget" URLs again (default 1000). only
+          the URLs that keep failing are reported, with the number of
+          attempts.
+         "results_file" receives the result records of the failed URLs of
+          the run (default temp_directory/results.jsonl), one JSON object
+          per line: status, category (the report), description, note, url,
+          mms_id, resource_type, latency, bytes, final_url and time. the
+          workers write their result_NNNN files (and a shard its results)
+          in the same format. results_file is replaced when the run sends
+          all its reports.
+         "report_mode" is "full" (default) to report every failed URL, or
+          "diff" to report the changes since the results_file of the last
+          run: the new failures (and the URLs that moved to another
+          report), and a "fixed since the last run" report of the URLs
+          that no longer fail. a merge (--merge) does not know the input
+          of the shards, so it reports as fixed every failed URL of the
+          last run that is not failing.
+         "large_input" is "yes" for inputs too large to dedupe in memory
+          (default "no"; it requires streaming=no): the lines are spread
+          over files in temp_directory by the hash of their URL, one file
+          per "partition_lines" input lines (default 200000), and the URLs
+          are deduped and tested one file at a time. the lines of a URL
+          are kept as integers where they can (mms_id and resource_type),
+          so memory stays about the same as the input grows. the reports
+          spill to temp_directory as usual; each email body is read when
+          it is mailed. the URLs are tested in the order of the files.
+         "progress_interval" is the number of seconds between the progress
+          lines written to stderr (default 60; 0: none): URLs tested, failed
+          and in flight, and the phase of the run (ingest, check, collate,
+          mail). "metrics_file" is a file for the textfile collector of
+          the Prometheus node_exporter (default none), rewritten with every
+          progress line and at the end: the seconds of each phase, the URLs
+          by return code, the requests in flight and the requests and
+          latency histogram of the "metrics_hosts" hosts with the most
+          requests (default 50). the multiprocess engine adds the per-host
+          figures when its processes finish. "summary_file" receives the
+          JSON summary of the run (default temp_directory/run_summary.json),
+          with every host, slowest first.
       the results reflect ALMA's records type: bibliographic or portfolio.
 """
 __author__ = 'bernardo gomez'
@@ -37,7 +228,10 @@ __date__ = 'june 2018'
 
 import time
 import random
+import array
 import requests
+import requests.adapters
+import urllib3.exceptions
 import re
 import subprocess
 import sys
@@ -45,237 +239,3059 @@ import os
 # emory would need it
 #import socks
 import socket
-from multiprocessing import Process, Lock
+import sqlite3
+import zlib
+import struct
+import hashlib
+import heapq
+import json
+import csv
+import itertools
+import tempfile
+import threading
+import queue
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+from urllib.parse import urlsplit, urlunsplit, urljoin
+import asyncio
+try:
+    import aiohttp
+except ImportError:
+    aiohttp=None
+from multiprocessing import Process, Lock, Array, Queue, Manager
 import smtplib
 from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
 
 # URL_@_record_id_@_resource_type
 
-def send_email(smtp_server,recipients,from_mail,body,subject):
+class Mailer(object):
+   """
+      a single SMTP session for all the reports of a run. the connection
+      is opened by the first message; when sending fails because the
+      connection broke, it reconnects once and sends the message again.
+      if that fails too, the server is given up and the later messages
+      are counted as unsent.
+   """
+   def __init__(self,smtp_server,timeout=30):
+      self.smtp_server=smtp_server
+      self.timeout=timeout
+      self.smtp=None
+      self.sent=0
+      self.unsent=0
+      self.failed=False
+
+   def send(self,from_mail,email_list,msg):
+      if self.failed:
+         self.unsent+=1
+         return 1
+      for attempt in range(2):
+         try:
+            if self.smtp is None:
+               self.smtp=smtplib.SMTP(self.smtp_server,timeout=self.timeout)
+            self.smtp.sendmail(from_mail,email_list,msg.as_string())
+            self.sent+=1
+            return 0
+         except (smtplib.SMTPRecipientsRefused,smtplib.SMTPSenderRefused,
+                 smtplib.SMTPDataError) as e:
+            sys.stderr.write("**ERROR: smtp server refused message: "+str(e)+"\n")
+            return 1
+         except OSError as e:
+            # SMTPServerDisconnected and socket errors.
+            self.drop()
+            if attempt > 0:
+               sys.stderr.write("**ERROR: couldn't send to smtp server: "+str(e)+"\n")
+      self.failed=True
+      self.unsent+=1
+      return 1
+
+   def drop(self):
+      if self.smtp is not None:
+         try:
+            self.smtp.close()
+         except OSError:
+            pass
+         self.smtp=None
+
+   def close(self):
+      if self.smtp is not None:
+         try:
+            self.smtp.quit()
+         except OSError:
+            pass
+         self.drop()
+      if self.unsent > 0:
+         sys.stderr.write("**ERROR: "+str(self.unsent)+" reports were not sent\n")
+
+def send_email(mailer,recipients,from_mail,body,subject,attachments=None):
    """
       it receives the necessary parameters to send an email message.
       parameters:
-        smtp_server = outbound mail server.
+        mailer = SMTP session of the outbound mail server (Mailer).
         recipients = email addresses separated by ","
         from_mail = email sender (e.g. do-not-reply@myplace.edu )
         body = email message body with results.
         subject =  email subject line.
+        attachments = list of (file name,text) attached to the message.
    """
    email_list=recipients.split(",")
-   msg = MIMEText(body,'plain','utf-8')
+   if attachments:
+      msg = MIMEMultipart()
+      msg.attach(MIMEText(body,'plain','utf-8'))
+      for filename,text in attachments:
+         part=MIMEText(text,'plain','utf-8')
+         part.add_header('Content-Disposition','attachment',filename=filename)
+         msg.attach(part)
+   else:
+      msg = MIMEText(body,'plain','utf-8')
+
+   msg['Subject'] = subject
+   msg['From'] = from_mail
+   msg['To'] = recipients
+   return mailer.send(from_mail,email_list,msg)
+
+def send_reports(mailer,aggregator,email_info,from_mail,mail_digest):
+   """
+      it mails the reports of aggregator (a ReportAggregator) to the
+      recipients of each resource type in email_info, one message per
+      report or, when mail_digest is True, one message per recipient
+      group with a report per attachment.
+   """
+   digests={}
+   for category,resource_type,body in aggregator.bodies():
+       subject=aggregator.subject[category]
+       if subject is None:
+           continue
+       try:
+           rname,recipients=email_info[resource_type].split("|")
+       except:
+           continue
+       if mail_digest:
+           # one message per recipient group, one attachment per report.
+           digests.setdefault(resource_type,[]).append((category,subject,body))
+           continue
+       send_email(mailer,recipients,from_mail,body,"[urlchecker "+rname+"] "+subject)
+   for resource_type in sorted(digests,key=int):
+       rname,recipients=email_info[resource_type].split("|")
+       summary=""
+       attachments=[]
+       for category,subject,body in digests[resource_type]:
+           summary+=subject+": "+str(body.count("\n"))+" URLs ("+category+".txt)\n"
+           attachments.append((category+".txt",body))
+       send_email(mailer,recipients,from_mail,summary,"[urlchecker "+rname+"] URL check report",
+                  attachments)
+   return
+
+
+## the reports: (category, return codes, subject), in the order they are
+## mailed. the subject follows "[urlchecker resource name] "; categories
+## without a subject are collated but not mailed.
+report_categories=(
+    ("not_found",("404","410"),"URL not found (nicht gefunden)"),
+    ("unknown_hostname",("603",),"unknown hostname (unbekannter gastgeber)"),
+    ("unsupported_HTTP_protocol",("607","501"),"unsupported HTTP protocol (nicht unterstütztes Protokoll)"),
+    ("ill_formed_url",("609",),"ill-formed URL"),
+    ("connection_failed",("610",),"connection failed"),
+    ("bad_request",("400",),"bad HTTP request"),
+    ("pass_required",("401",),"permission required"),
+    ("forbidden",("403",),"access forbidden"),
+    ("internal_error",("500",),"system error"),
+    ("tls_failed",("611",),"TLS handshake failed"),
+    ("too_many_redirects",("612",),"too many redirects"),
+    ("redirect_loop",("613",),"redirect loop"),
+    ("connection_timedout",("605",),None),
+    ("unknown_exception",("608",),None)
+)
+
+class ReportAggregator(object):
+    """
+       the failed URLs collated by (category, resource_type), see
+       report_categories. add() takes result records and write() the
+       lines of a result file (see RecordFile) as they arrive. the lines
+       of each bucket are appended to a spooled file (in memory up to
+       spool_size bytes, then in directory), so collation is linear in
+       the number of failures and bodies() renders each email body once.
+       every record is also kept in archive (a path, or None), which
+       commit() replaces at the end of the run.
+       with baseline, the failures of the previous run (see
+       read_baseline), only the changes are reported: a failure that was
+       already in baseline with the same category is left out, and the
+       input lines of baseline that are no longer failing are reported
+       as "fixed". lines() marks the input lines of the run; when it is
+       not used every line of baseline counts as tested.
+    """
+    def __init__(self,directory=None,spool_size=1048576,archive=None,baseline=None):
+        self.directory=directory
+        self.spool_size=spool_size
+        self.order={}
+        self.subject={}
+        for k in range(len(report_categories)):
+            category,codes,subject=report_categories[k]
+            self.order[category]=k
+            self.subject[category]=subject
+        self.buckets={}
+        self.archive=archive
+        self.archive_f=None
+        if archive is not None:
+            self.archive_f=RecordFile(open(archive+".tmp","w",encoding="utf-8"))
+        self.baseline=baseline
+        self.present=None
+        self.failing=set()
+        self.unchanged=0
+        self.fixed=0
+        if baseline is not None:
+            for category in self.subject:
+                if self.subject[category] is not None:
+                    self.subject[category]="new: "+self.subject[category]
+            self.order["fixed"]=len(report_categories)
+            self.subject["fixed"]="fixed since the last run"
+
+    def lines(self,items):
+        """
+          it yields the (url,line) items of items and marks the lines
+          that are in baseline as tested in this run.
+        """
+        if self.baseline is None:
+            yield from items
+            return
+        self.present=set()
+        for url,i_line in items:
+            if i_line in self.baseline:
+                self.present.add(i_line)
+            yield url,i_line
+
+    def write(self,line):
+        """
+          it adds the result record of a line of a result file.
+        """
+        try:
+            record=json.loads(line)
+        except ValueError:
+            sys.stderr.write("**ERR: failed to process HTTP results"+"\n")
+            return
+        self.add(record)
+
+    def add(self,record):
+        """
+          it adds a result record (see result_record); records of
+          categories that are not reported are only archived.
+        """
+        if self.archive_f is not None:
+            self.archive_f.add(record)
+        category=record["category"]
+        resource_type=record["resource_type"]
+        if category not in self.order or resource_type is None:
+            if resource_type is None:
+                sys.stderr.write("**ERR: failed to process HTTP results"+"\n")
+            return
+        if self.baseline is not None:
+            key=record_key(record)
+            self.failing.add(key)
+            if self.baseline.get(key) == category:
+                self.unchanged+=1
+                return
+        target=record["url"]
+        if record["note"] == "inferred":
+            target=target+" (inferred: host not responding, not tested)"
+        elif record["note"] != "":
+            target=target+" ("+record["note"]+")"
+        self.bucket(category,str(resource_type)).write(target+" mms_id: "+record["mms_id"]+"\n")
+
+    def bucket(self,category,resource_type):
+        key=(category,resource_type)
+        bucket=self.buckets.get(key)
+        if bucket is None:
+            bucket=tempfile.SpooledTemporaryFile(max_size=self.spool_size,mode="w+",
+                                                 encoding="utf-8",dir=self.directory)
+            self.buckets[key]=bucket
+        return bucket
+
+    def collate_fixed(self):
+        """
+          it adds the "fixed" reports: the reported failures of baseline
+          whose lines were tested and did not fail in this run.
+        """
+        for i_line in sorted(self.baseline):
+            category=self.baseline[i_line]
+            if self.subject.get(category) is None or i_line in self.failing:
+                continue
+            if self.present is not None and i_line not in self.present:
+                continue
+            url,mms_id,resource_type=i_line.split("_|_")
+            self.bucket("fixed",resource_type).write(url+" mms_id: "+mms_id+" (was: "+category+")\n")
+            self.fixed+=1
+
+    def bodies(self):
+        """
+          it yields (category,resource_type,body) for the buckets that
+          hold failed URLs, in the order of report_categories.
+        """
+        if self.baseline is not None and self.fixed == 0:
+            self.collate_fixed()
+        keys=sorted(self.buckets,key=lambda key: (self.order[key[0]],int(key[1])))
+        for key in keys:
+            bucket=self.buckets[key]
+            bucket.seek(0)
+            yield key[0],key[1],bucket.read()
+
+    def commit(self):
+        """
+          it replaces archive with the records of this run.
+        """
+        if self.archive_f is not None:
+            self.archive_f.close()
+            self.archive_f=None
+            os.replace(self.archive+".tmp",self.archive)
+
+    def close(self):
+        for bucket in self.buckets.values():
+            bucket.close()
+        self.buckets={}
+        if self.archive_f is not None:
+            self.archive_f.close()
+            self.archive_f=None
+            os.unlink(self.archive+".tmp")
+
+def read_baseline(path):
+    """
+      it returns the failures of the result file path, the archive of
+      the previous run (see ReportAggregator): input line -> category.
+      there is no baseline (an empty one) when path does not exist.
+    """
+    baseline={}
+    if not os.path.exists(path):
+        return baseline
+    for record in read_records(path):
+        if record.get("resource_type") is not None:
+            baseline[record_key(record)]=record["category"]
+    return baseline
+
+## the 6XX error type of the exceptions raised by requests, urllib3 and
+## aiohttp: (error type, specific, class names). a generic class (e.g. a
+## failed connection) gives its error type only when no exception of the
+## chain has a specific one (see classify_exception).
+exception_names=(
+    ("603",True,("socket.gaierror","urllib3.exceptions.NameResolutionError",
+                 "aiohttp.ClientConnectorDNSError")),
+    ("611",True,("ssl.SSLError","ssl.CertificateError","requests.exceptions.SSLError",
+                 "urllib3.exceptions.SSLError","aiohttp.ClientSSLError")),
+    ("612",True,("requests.exceptions.TooManyRedirects","aiohttp.TooManyRedirects")),
+    ("610",True,("requests.exceptions.ConnectTimeout","urllib3.exceptions.ConnectTimeoutError",
+                 "aiohttp.ConnectionTimeoutError")),
+    ("605",True,("requests.exceptions.ReadTimeout","urllib3.exceptions.ReadTimeoutError",
+                 "aiohttp.ServerTimeoutError","builtins.TimeoutError")),
+    ("607",True,("requests.exceptions.InvalidSchema","aiohttp.NonHttpUrlClientError")),
+    ("609",True,("requests.exceptions.MissingSchema","requests.exceptions.InvalidURL",
+                 "urllib3.exceptions.LocationParseError","aiohttp.InvalidURL",
+                 "builtins.UnicodeError")),
+    ("610",False,("requests.exceptions.ConnectionError","urllib3.exceptions.NewConnectionError",
+                  "urllib3.exceptions.ProtocolError","aiohttp.ClientConnectorError",
+                  "aiohttp.ClientOSError","aiohttp.ServerDisconnectedError",
+                  "builtins.ConnectionError"))
+)
+
+def exception_table(names):
+    """
+      it returns the dispatch table of classify_exception:
+      class -> (error type, specific). classes of modules that are not
+      loaded (e.g. aiohttp) are left out.
+    """
+    table={}
+    for return_code,specific,class_names in names:
+        for name in class_names:
+            module_name,dot,class_name=name.rpartition(".")
+            klass=getattr(sys.modules.get(module_name),class_name,None)
+            if klass is not None and klass not in table:
+                table[klass]=(return_code,specific)
+    return table
+
+exception_codes=exception_table(exception_names)
+
+def exception_chain(e):
+    """
+      it yields e and the exceptions it wraps, outermost first: requests
+      wraps the urllib3 exception, which holds the socket error in reason.
+    """
+    seen=set()
+    chain=deque([e])
+    while len(chain) > 0 and len(seen) < 10:
+        error=chain.popleft()
+        if id(error) in seen:
+            continue
+        seen.add(id(error))
+        yield error
+        wrapped=[getattr(error,"reason",None),getattr(error,"os_error",None),
+                 error.__cause__,error.__context__]
+        if len(error.args) > 0:
+            wrapped.insert(0,error.args[0])
+        for inner in wrapped:
+            if isinstance(inner,BaseException):
+                chain.append(inner)
+
+def classify_exception(e):
+    """
+      it returns the 6XX error type of an exception raised by a request,
+      from the classes of the exception and of the exceptions it wraps.
+      a class that is not in exception_codes gets the entry of its
+      nearest base class, which is then kept in the table.
+    """
+    generic=None
+    for error in exception_chain(e):
+        klass=type(error)
+        if klass not in exception_codes:
+            entry=None
+            for base in klass.__mro__:
+                if base in exception_codes:
+                    entry=exception_codes[base]
+                    break
+            exception_codes[klass]=entry
+        entry=exception_codes[klass]
+        if entry is None:
+            continue
+        if entry[1]:
+            return entry[0]
+        if generic is None:
+            generic=entry[0]
+    if generic is not None:
+        return generic
+    return "608"
+
+## description of the local 6XX error types. it is written into the
+## third field of a result record.
+error_description={
+    "603":"unknown hostname",
+    "605":"connection timed out",
+    "607":"unsupported HTTP protocol",
+    "608":"Unknown Python exception",
+    "609":"Ill-formed URL",
+    "610":"Connection to server failed",
+    "611":"TLS handshake failed",
+    "612":"too many redirects",
+    "613":"redirect loop"
+}
+
+## PURL resolvers of the PURL resolution stage: hostname -> (use https,
+## unwrap EZproxy). emory libraries use pid.emory.edu. other hosts of
+## purl_hosts are resolved with their Location header as is.
+purl_resolvers={
+    "pid.emory.edu":(True,True),
+    "purl.access.gpo.gov":(False,False),
+    "hdl.handle.net":(False,False)
+}
+
+## pid would contain an ezproxy URL. get ezproxy's target for testing.
+ezproxy=re.compile(r".*\?url=(.*)")
+
+## return code -> report category (see report_categories).
+report_category=dict((return_code,category) for category,codes,subject in report_categories
+                     for return_code in codes)
+
+def result_record(return_code,description,i_line,note="",details=None):
+    """
+       it returns the result record of an input line, a dict written as
+       one JSON line (see RecordFile):
+       status, category (the report, "other" if none), description, note,
+       url, mms_id, resource_type, latency (seconds), bytes, final_url and
+       time (when the test started, UTC).
+       note is "inferred" when the URL was not requested because the
+       circuit breaker of its host was open. details is the
+       (latency,bytes,final_url,started) of the test (see Outcome); it is
+       None for results that were not measured.
+    """
+    field=i_line.split("_|_")
+    if len(field) != 3:
+        field=[i_line,"",None]
+    url,mms_id,resource_type=field
+    try:
+        resource_type=int(resource_type)
+    except (TypeError,ValueError):
+        resource_type=None
+    return_code=str(return_code)
+    latency,size,final_url,started=details if details is not None else (None,None,None,None)
+    if started is not None:
+        started=time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime(started))
+    return {"status":return_code,"category":report_category.get(return_code,"other"),
+            "description":description,"note":note,"url":url,"mms_id":mms_id,
+            "resource_type":resource_type,"latency":latency,"bytes":size,
+            "final_url":final_url if final_url != url else None,"time":started}
+
+def record_key(record):
+    """
+      it returns the key of the input line of a result record.
+    """
+    return record["url"]+"_|_"+record["mms_id"]+"_|_"+str(record["resource_type"])
+
+class RecordFile(object):
+    """
+       a file of result records, one JSON object per line (see
+       result_record). add() takes a record, write() a line of another
+       result file.
+    """
+    def __init__(self,output_f):
+        self.output_f=output_f
+
+    def add(self,record):
+        self.output_f.write(json.dumps(record,ensure_ascii=False,separators=(",",":"))+"\n")
+
+    def write(self,line):
+        self.output_f.write(line)
+
+    def close(self):
+        self.output_f.close()
+
+def read_records(path):
+    """
+      it yields the result records of the result file path (see
+      RecordFile); a line that is not a record is skipped with an error.
+    """
+    with open(path,"r",encoding="utf-8") as record_f:
+        for line in record_f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                sys.stderr.write("**ERR: invalid result record in "+path+"\n")
+
+class ExcludeMatcher(object):
+    """
+       the strings of the exclude file compiled into an Aho-Corasick
+       automaton. matches(url) is True when url contains one of the
+       strings, like url.find(x_string) > -1 for some x_string, but it
+       reads url once instead of once per string.
+    """
+    def __init__(self,exclusion):
+        # an empty string is found in every URL.
+        self.match_all="" in exclusion
+        self.goto=[{}]
+        self.fail=[0]
+        self.out=[False]
+        for x_string in exclusion:
+            state=0
+            for c in x_string:
+                next_state=self.goto[state].get(c)
+                if next_state is None:
+                    next_state=len(self.goto)
+                    self.goto[state][c]=next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(False)
+                state=next_state
+            self.out[state]=True
+        # breadth-first: the failure link of a state points to the state
+        # of its longest proper suffix.
+        queue=deque(self.goto[0].values())
+        while len(queue) > 0:
+            state=queue.popleft()
+            for c,next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback=self.fail[state]
+                while fallback and c not in self.goto[fallback]:
+                    fallback=self.fail[fallback]
+                self.fail[next_state]=self.goto[fallback].get(c,0)
+                if self.out[self.fail[next_state]]:
+                    self.out[next_state]=True
+
+    def matches(self,url):
+        if self.match_all:
+            return True
+        goto=self.goto
+        fail=self.fail
+        out=self.out
+        state=0
+        for c in url:
+            while state and c not in goto[state]:
+                state=fail[state]
+            state=goto[state].get(c,0)
+            if out[state]:
+                return True
+        return False
+
+def select_lines(input_f,exclusion):
+    """
+      it reads the URL lines from input_f and yields (url,line) for
+      the URLs that must be tested.
+      it skips invalid lines and URLs that contain an excluded string
+      (exclusion is an ExcludeMatcher).
+    """
+    delim="_|_"
+    for i_line in input_f:
+        i_line=i_line.rstrip("\n")
+        try:
+            url,mms_id,record_type=i_line.split(delim)
+        except:
+            sys.stderr.write("**ERROR: invalid input line.\n")
+            continue
+        ## if URL contains an excluded string then
+        ## do not test the URL.
+        if exclusion.matches(url):
+            continue
+        yield url,i_line
+
+## default table of ALMA resource types: CSV name -> resource_type.
+alma_resource_types={
+    "Bibliographic Record":"1",
+    "Portfolio":"2"
+}
+
+def alma_csv_lines(input_f,delimiter=",",resource_types=alma_resource_types,unique=True):
+    """
+      it reads an ALMA CSV export from input_f, with lines like
+      Portfolio,53284293680002486,http://purl.access.gpo.gov/GPO/LPS125131
+      and yields the lines of the URL checker format:
+      URL_|_mms_id_|_resource_type
+      quoted fields may contain the delimiter or line breaks.
+      resource_types maps the first field to the resource_type; rows of
+      other types (e.g. the header) are skipped. repeated rows are
+      yielded once (like sort -u); a row is remembered by a 64-bit hash.
+      with unique False they are all yielded (see PartitionDedupe).
+    """
+    seen=set()
+    unknown=set()
+    for row in csv.reader(input_f,delimiter=delimiter):
+        if len(row) < 3:
+            if len(row) > 0:
+                sys.stderr.write("**ERROR: invalid CSV line.\n")
+            continue
+        r_name=row[0].lstrip("\ufeff").strip()
+        if r_name not in resource_types:
+            if r_name not in unknown:
+                unknown.add(r_name)
+                sys.stderr.write("rows skipped, unknown resource type: "+r_name+"\n")
+            continue
+        i_line=row[2].strip()+"_|_"+row[1].strip()+"_|_"+resource_types[r_name]
+        if not unique:
+            yield i_line
+            continue
+        digest=hashlib.blake2b(i_line.encode("utf-8"),digest_size=8).digest()
+        key=int.from_bytes(digest,"big")
+        if key in seen:
+            continue
+        seen.add(key)
+        yield i_line
+
+def normalize_url(url):
+    """
+      it returns the form of url used to detect duplicates: lower case
+      scheme and hostname, no default port, no fragment and no trailing
+      slash in the path.
+    """
+    try:
+        parts=urlsplit(url)
+        port=parts.port
+    except ValueError:
+        return url
+    scheme=parts.scheme.lower()
+    netloc=parts.netloc
+    if parts.hostname is not None:
+        netloc=parts.hostname
+        if ":" in netloc:
+            netloc="["+netloc+"]"
+        if port is not None and not ((scheme == "http" and port == 80) or
+                                     (scheme == "https" and port == 443)):
+            netloc=netloc+":"+str(port)
+        userinfo=parts.netloc.rpartition("@")
+        if userinfo[1] == "@":
+            netloc=userinfo[0]+"@"+netloc
+    path=parts.path.rstrip("/")
+    return urlunsplit((scheme,netloc,path,parts.query,""))
+
+def dedupe_urls(items):
+    """
+      it groups the (url,line) items by normalized URL and returns
+      (distinct,line_count): distinct is a list of (url,lines,validators)
+      with one entry per distinct URL, in the order of first appearance;
+      lines are all the input lines (all mms_ids) that reference the URL;
+      validators are the headers of a conditional request (see
+      apply_cache), empty here.
+    """
+    distinct={}
+    line_count=0
+    for url,i_line in items:
+        line_count+=1
+        key=normalize_url(url)
+        if key in distinct:
+            distinct[key][1].append(i_line)
+        else:
+            distinct[key]=(url,[i_line],{})
+    return list(distinct.values()),line_count
+
+class ResultCache(object):
+    """
+       the last result of each URL (normalized), kept between runs in an
+       SQLite file. return_code is NULL for a healthy URL; checked is the
+       time of the test; etag and last_modified are the validators of the
+       response. several processes may share the file: the writes are
+       kept in memory and written in batches, each in a short transaction
+       (see flush), so a worker never holds the write lock while it makes
+       requests.
+    """
+    def __init__(self,path,batch=100):
+        # the streaming mode reads the cache in the thread of the input
+        # (see idle_marks).
+        self.db=sqlite3.connect(path,timeout=60,check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS url_result (url TEXT PRIMARY KEY,"
+                        " return_code TEXT, checked REAL, etag TEXT, last_modified TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS purl_target (purl TEXT PRIMARY KEY,"
+                        " target TEXT, resolved REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS host_latency (host TEXT PRIMARY KEY,"
+                        " srtt REAL, rttvar REAL, samples INTEGER, updated REAL)")
+        self.db.commit()
+        self.batch=batch
+        self.pending=[]
+
+    def get(self,url):
+        """
+          it returns (return_code,checked,etag,last_modified) or None.
+        """
+        cursor=self.db.execute("SELECT return_code,checked,etag,last_modified"
+                               " FROM url_result WHERE url=?",(normalize_url(url),))
+        return cursor.fetchone()
+
+    def put(self,url,outcome):
+        self.store("INSERT OR REPLACE INTO url_result VALUES (?,?,?,?,?)",
+                   (normalize_url(url),outcome.return_code,time.time(),
+                    outcome.etag,outcome.last_modified))
+
+    def get_target(self,purl):
+        """
+          it returns (target,resolved) of a PURL or None.
+        """
+        cursor=self.db.execute("SELECT target,resolved FROM purl_target WHERE purl=?",
+                               (normalize_url(purl),))
+        return cursor.fetchone()
+
+    def put_target(self,purl,target):
+        self.store("INSERT OR REPLACE INTO purl_target VALUES (?,?,?)",
+                   (normalize_url(purl),target,time.time()))
+
+    def latencies(self):
+        """
+          it returns the answer time estimates of the hosts (see
+          HostTimeouts): hostname -> (srtt,rttvar,samples).
+        """
+        cursor=self.db.execute("SELECT host,srtt,rttvar,samples FROM host_latency")
+        return dict((host,(srtt,rttvar,samples)) for host,srtt,rttvar,samples in cursor)
+
+    def put_latency(self,hostname,srtt,rttvar,samples):
+        self.store("INSERT OR REPLACE INTO host_latency VALUES (?,?,?,?,?)",
+                   (hostname,srtt,rttvar,samples,time.time()))
+
+    def store(self,statement,row):
+        self.pending.append((statement,row))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """
+          it writes the pending rows in one transaction. a write that
+          fails (e.g. the file stays locked) loses the rows, not the run.
+        """
+        if len(self.pending) == 0:
+            return
+        try:
+            with self.db:
+                for statement,row in self.pending:
+                    self.db.execute(statement,row)
+        except sqlite3.Error as e:
+            sys.stderr.write("**ERR: couldn't write "+str(len(self.pending))+" rows to the cache: "+str(e)+"\n")
+        self.pending=[]
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+def worker_cache(path,lock):
+    """
+      it returns the ResultCache of a worker, or None when path is None
+      or the cache can't be opened: the URLs are tested anyway.
+    """
+    if path is None:
+        return None
+    try:
+        return ResultCache(path)
+    except sqlite3.Error as e:
+        with lock:
+            sys.stderr.write("**ERR: couldn't use cache "+path+": "+str(e)+"\n")
+        return None
+
+def apply_cache(items,cache,ttl):
+    """
+      it returns (items,skipped): the items that must be tested and the
+      number of items skipped because they were healthy less than ttl
+      seconds ago. healthy items older than ttl get the validators of a
+      conditional request; failed items are always tested again.
+    """
+    kept=[]
+    skipped=0
+    now=time.time()
+    for url,lines,validators in items:
+        validators=cache_validators(cache,url,ttl,now,validators)
+        if validators is None:
+            skipped+=1
+            continue
+        kept.append((url,lines,validators))
+    return kept,skipped
+
+def cache_validators(cache,url,ttl,now,validators):
+    """
+      it returns None when url was healthy less than ttl seconds before
+      now, otherwise validators with the headers of a conditional request
+      when url was healthy before.
+    """
+    row=cache.get(url)
+    if row is not None and row[0] is None:
+        if now-row[1] < ttl:
+            return None
+        if row[2]:
+            validators["If-None-Match"]=row[2]
+        if row[3]:
+            validators["If-Modified-Since"]=row[3]
+    return validators
+
+class ResultWriter(object):
+    """
+       it adds the result records of a failed URL to output (a RecordFile
+       or a ReportAggregator), one for every input line that references
+       the URL.
+    """
+    def __init__(self,output):
+        self.output=output
+
+    def result(self,lines,return_code,description,note,details=None):
+        if return_code is None:
+            return
+        for i_line in lines:
+            self.output.add(result_record(return_code,description,i_line,note,details))
+
+class QueueResults(object):
+    """
+       it sends the results of a worker process to the main process
+       through result_queue (streaming mode); the URL is identified by
+       its StreamDedupe key instead of its lines.
+    """
+    def __init__(self,result_queue):
+        self.result_queue=result_queue
+
+    def result(self,key,return_code,description,note,details=None):
+        self.result_queue.put((key,return_code,description,note,details))
+
+## the result of a healthy URL in StreamDedupe.
+healthy_result=(None,"","",None)
+
+def url_key(url):
+    """
+      it returns a 64-bit hash of the normalized url.
+    """
+    digest=hashlib.blake2b(normalize_url(url).encode("utf-8"),digest_size=8).digest()
+    return int.from_bytes(digest,"big")
+
+class StreamDedupe(object):
+    """
+       the dedupe stage of the streaming mode: the URL lines are tested
+       while they are read, so the input is never copied or sorted.
+       items() yields (url,key,validators) for the first line of each
+       distinct URL; the later lines of the URL wait for its result.
+       result() receives the result of a key and writes the records of
+       all the lines of the URL through writer (a ResultWriter); lines
+       read after the result get it at once. a URL is remembered by a
+       64-bit hash of its normalized form (see url_key), so memory grows
+       with the distinct URLs, not with the input lines. items() may run in
+       a reader thread while result() is called by the engine (see
+       idle_marks), so both hold lock.
+    """
+    def __init__(self,writer):
+        self.writer=writer
+        self.lock=threading.RLock()
+        self.seen={}
+        self.line_count=0
+        self.url_count=0
+        self.skipped=0
+        self.resumed=0
+
+    def items(self,lines,cache=None,ttl=0,journaled=None):
+        """
+          it yields the (url,key,validators) items to test from the
+          (url,line) items of lines. URLs that were healthy less than ttl
+          seconds ago in cache (a ResultCache) are not tested, nor the
+          URLs whose result is in journaled (see read_journal).
+        """
+        for url,i_line in lines:
+            with self.lock:
+                item=self.line(url,i_line,cache,ttl,journaled)
+            if item is not None:
+                yield item
+
+    def line(self,url,i_line,cache,ttl,journaled):
+        """
+          it returns the item to test for an input line, or None.
+        """
+        self.line_count+=1
+        key=url_key(url)
+        state=self.seen.get(key)
+        if state is None:
+            self.url_count+=1
+            self.seen[key]=[i_line]
+            if journaled is not None and key in journaled:
+                self.resumed+=1
+                self.result(key,*journaled[key])
+                return None
+            validators={}
+            if cache is not None:
+                validators=cache_validators(cache,url,ttl,time.time(),validators)
+                if validators is None:
+                    self.skipped+=1
+                    self.result(key,*healthy_result)
+                    return None
+            return url,key,validators
+        elif isinstance(state,list):
+            state.append(i_line)
+        else:
+            self.writer.result([i_line],*state)
+        return None
+
+    def result(self,key,return_code,description,note,details=None):
+        with self.lock:
+            lines=self.seen[key]
+            if return_code is None:
+                self.seen[key]=healthy_result
+            else:
+                self.seen[key]=(return_code,description,note,details)
+            self.writer.result(lines,return_code,description,note,details)
+
+## mms_ids and resource types that UrlLines keeps as numbers: no sign, no
+## leading zero, below 2**64 and 256.
+plain_mms_id=re.compile(r"(0|[1-9][0-9]{0,18})$")
+plain_resource_type=re.compile(r"(0|[1-9][0-9]{0,2})$")
+
+class UrlLines(object):
+    """
+       the input lines of a distinct URL in large-input mode, stored
+       compactly: a line of url whose mms_id and resource_type are plain
+       numbers is an entry of the array of 64-bit mms_ids and of the
+       bytearray of resource types; the other lines are kept as they are.
+       iterating yields the lines (URL_|_mms_id_|_resource_type).
+    """
+    __slots__=("url","mms_ids","types","other")
+
+    def __init__(self,url):
+        self.url=url
+        self.mms_ids=array.array("Q")
+        self.types=bytearray()
+        self.other=None
+
+    def append(self,i_line):
+        field=i_line.split("_|_")
+        if (len(field) == 3 and field[0] == self.url and plain_mms_id.match(field[1])
+                and plain_resource_type.match(field[2]) and int(field[2]) < 256):
+            self.mms_ids.append(int(field[1]))
+            self.types.append(int(field[2]))
+            return
+        if self.other is None:
+            self.other=[]
+        self.other.append(i_line)
+
+    def __len__(self):
+        return len(self.mms_ids)+(len(self.other) if self.other is not None else 0)
+
+    def __iter__(self):
+        for k in range(len(self.mms_ids)):
+            yield self.url+"_|_"+str(self.mms_ids[k])+"_|_"+str(self.types[k])
+        if self.other is not None:
+            yield from self.other
+
+## a record of a PartitionDedupe file: url_key, URL and line lengths.
+partition_record=struct.Struct("<QII")
+
+class PartitionDedupe(object):
+    """
+       the dedupe stage of the large-input mode: partition() spreads the
+       (url,line) items over partition files in directory by the hash of
+       their normalized URL (see url_key), so all the lines of a URL land
+       in the same file. items() then dedupes one partition at a time and
+       deletes it, so memory grows with the largest partition instead of
+       the input. a distinct URL is a UrlLines; the hostnames are kept
+       once each, for the DNS pre-resolution stage. with unique, repeated
+       lines are dropped there, one partition at a time, instead of in
+       alma_csv_lines.
+    """
+    def __init__(self,writer,directory,partitions,unique=False):
+        self.writer=writer
+        self.unique=unique
+        self.paths=[directory+"partition_"+'{:04d}'.format(k) for k in range(partitions)]
+        self.hostnames=set()
+        self.line_count=0
+        self.url_count=0
+        self.skipped=0
+        self.resumed=0
+
+    def partition(self,lines):
+        """
+          it writes the (url,line) items of lines to the partition files,
+          as binary records: the hash and the lengths of the URL and of
+          the line (see partition_record), then both in UTF-8, so a line
+          break in a quoted CSV field is kept as it is.
+        """
+        partition_f=[open(path,"wb") for path in self.paths]
+        try:
+            for url,i_line in lines:
+                self.line_count+=1
+                key=url_key(url)
+                self.hostnames.add(http_host(url))
+                url_bytes=url.encode("utf-8","surrogatepass")
+                line_bytes=i_line.encode("utf-8","surrogatepass")
+                partition_f[key % len(partition_f)].write(partition_record.pack(key,len(url_bytes),len(line_bytes))+
+                                                          url_bytes+line_bytes)
+        finally:
+            for output_f in partition_f:
+                output_f.close()
+
+    def items(self,cache=None,ttl=0,journaled=None):
+        """
+          it yields the (url,lines,validators) items to test, lines being
+          a UrlLines. URLs that were healthy less than ttl seconds ago in
+          cache (a ResultCache) are not tested, nor the URLs whose result
+          is in journaled (see read_journal).
+        """
+        for path in self.paths:
+            distinct={}
+            rows=set()
+            with open(path,"rb") as partition_f:
+                while True:
+                    header=partition_f.read(partition_record.size)
+                    if len(header) < partition_record.size:
+                        break
+                    key,url_size,line_size=partition_record.unpack(header)
+                    url_bytes=partition_f.read(url_size)
+                    line_bytes=partition_f.read(line_size)
+                    if self.unique:
+                        row=hashlib.blake2b(line_bytes,digest_size=8).digest()
+                        if row in rows:
+                            self.line_count-=1
+                            continue
+                        rows.add(row)
+                    lines=distinct.get(key)
+                    if lines is None:
+                        lines=UrlLines(url_bytes.decode("utf-8","surrogatepass"))
+                        distinct[key]=lines
+                    lines.append(line_bytes.decode("utf-8","surrogatepass"))
+            rows=None
+            os.unlink(path)
+            self.url_count+=len(distinct)
+            now=time.time()
+            for key,lines in distinct.items():
+                if journaled is not None and key in journaled:
+                    self.resumed+=1
+                    self.writer.result(lines,*journaled[key])
+                    continue
+                validators={}
+                if cache is not None:
+                    validators=cache_validators(cache,lines.url,ttl,now,validators)
+                    if validators is None:
+                        self.skipped+=1
+                        continue
+                yield lines.url,lines,validators
+
+class Journal(object):
+    """
+       the checkpoint journal of a worker. record() appends the result of
+       a tested URL to path as a JSON list: key, return_code, description,
+       note and the details of the test (see url_key and Outcome.details;
+       return_code is null for a healthy URL). the records are
+       written and fsync'ed in batches of batch records, or when the
+       oldest one is interval seconds old, so an interrupted run loses at
+       most a batch per worker (see read_journal).
+    """
+    def __init__(self,path,batch=200,interval=10.0):
+        self.fd=os.open(path,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+        self.batch=batch
+        self.interval=interval
+        self.pending=[]
+        self.oldest=0
+
+    def record(self,url,outcome):
+        if len(self.pending) == 0:
+            self.oldest=time.time()
+        self.pending.append(json.dumps(['{:016x}'.format(url_key(url)),outcome.return_code,
+                                        outcome.description,outcome.note,outcome.details()],
+                                       ensure_ascii=False,separators=(",",":"))+"\n")
+        if len(self.pending) >= self.batch or time.time()-self.oldest >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        os.write(self.fd,"".join(self.pending).encode("utf-8"))
+        os.fsync(self.fd)
+        self.pending=[]
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+def journal_files(directory):
+    """
+      it returns the paths of the journal_NNNN files in directory.
+    """
+    try:
+        names=os.listdir(directory)
+    except OSError:
+        return []
+    return [os.path.join(directory,name) for name in sorted(names) if name.startswith("journal_")]
+
+def read_journal(directory):
+    """
+      it returns the results recorded in the journal_NNNN files of
+      directory (see Journal): key -> (return_code,description,note,details),
+      with return_code None for a healthy URL. a record cut short by
+      the interruption is ignored.
+    """
+    journaled={}
+    for path in journal_files(directory):
+        with open(path,"r",encoding="utf-8",errors="replace") as journal_f:
+            for record in journal_f:
+                try:
+                    key,return_code,description,note,details=json.loads(record)
+                    key=int(key,16)
+                except (ValueError,TypeError):
+                    continue
+                journaled[key]=(return_code,description,note,tuple(details))
+    return journaled
+
+def apply_journal(items,journaled,writer):
+    """
+      it returns (items,resumed): the items that must be tested, and the
+      number of items whose result was in journaled (see read_journal);
+      their results go to writer (a ResultWriter).
+    """
+    kept=[]
+    resumed=0
+    for url,lines,validators in items:
+        state=journaled.get(url_key(url))
+        if state is None:
+            kept.append((url,lines,validators))
+            continue
+        resumed+=1
+        writer.result(lines,*state)
+    return kept,resumed
+
+def url_host(url):
+    """
+      it returns the lower case hostname of url ("" if there is none).
+    """
+    try:
+        hostname=urlsplit(url).hostname
+    except ValueError:
+        return ""
+    if hostname is None:
+        return ""
+    return hostname.lower()
+
+def http_host(url):
+    """
+      it returns the lower case hostname of url when it is an http or
+      https URL ("" otherwise): the other schemes are never requested, so
+      their hostnames are not resolved.
+    """
+    try:
+        scheme=urlsplit(url).scheme.lower()
+    except ValueError:
+        return ""
+    if scheme not in ("http","https"):
+        return ""
+    return url_host(url)
+
+def url_server(url):
+    """
+      it returns "hostname:port" for url, the server that answers the
+      request.
+    """
+    try:
+        parts=urlsplit(url)
+        port=parts.port
+    except ValueError:
+        return url_host(url)
+    if port is None:
+        port=443 if parts.scheme.lower() == "https" else 80
+    return url_host(url)+":"+str(port)
+
+def host_in(hostname,host_list):
+    """
+      it returns True if hostname is in host_list or is a subdomain of a
+      host in host_list.
+    """
+    for host in host_list:
+        if hostname == host or hostname.endswith("."+host):
+            return True
+    return False
+
+def jump_hash(key,buckets):
+    """
+      it maps the 64-bit key to one of buckets with the jump consistent
+      hash of Lamping and Veach: when buckets grows, only the keys that
+      move to the new buckets change.
+    """
+    bucket=-1
+    k=0
+    while k < buckets:
+        bucket=k
+        key=(key*2862933555777941757+1) & 0xffffffffffffffff
+        k=int((bucket+1)*(float(1 << 31)/float((key >> 33)+1)))
+    return bucket
+
+def shard_lines(items,index,count,purl_hosts=()):
+    """
+      it yields the (url,line) items of shard index (0,1..count-1): the
+      URLs are partitioned by a consistent hash of their hostname, so all
+      the URLs of a host are tested by one shard. the PURLs of purl_hosts
+      are partitioned by the whole URL, so their resolution is shared by
+      the shards.
+    """
+    shards={}
+    for url,i_line in items:
+        hostname=url_host(url)
+        if host_in(hostname,purl_hosts):
+            key=url_key(url)
+            if jump_hash(key,count) == index:
+                yield url,i_line
+            continue
+        shard=shards.get(hostname)
+        if shard is None:
+            digest=hashlib.blake2b(hostname.encode("utf-8"),digest_size=8).digest()
+            shard=jump_hash(int.from_bytes(digest,"big"),count)
+            shards[hostname]=shard
+        if shard == index:
+            yield url,i_line
+
+def shard_file(shard_directory,index,count):
+    return os.path.join(shard_directory,"shard_"+str(index)+"_of_"+str(count)+".txt")
+
+def merge_shards(shard_directory,count,aggregator):
+    """
+      it collates the result records of the count shards of a sharded run
+      into aggregator (a ReportAggregator) and returns the indexes of the
+      shards whose file is missing in shard_directory.
+    """
+    missing=[]
+    for index in range(count):
+        try:
+            shard_f=open(shard_file(shard_directory,index,count),'r')
+        except OSError:
+            missing.append(index)
+            continue
+        for line in shard_f:
+            aggregator.write(line)
+        shard_f.close()
+    return missing
+
+def response_size(headers,body_size):
+    """
+      it returns the approximate number of bytes of a response:
+      status line, headers and body_size bytes of body.
+    """
+    size=len("HTTP/1.1 200 OK\r\n\r\n")+body_size
+    for name,value in headers.items():
+        size+=len(name)+len(value)+4
+    return size
+
+def probe(url,options,headers=None):
+    """
+      it yields the requests that get the status and headers of url and
+      returns the reply (status_code,headers,bytes) of the last request.
+      a request is (method,url,stream,headers); stream=True means that
+      the response body must not be read; headers are extra request
+      headers (e.g. the validators of a conditional request) or None.
+      with options["probe"] == "head", it sends HEAD first and falls back
+      to a streamed GET, closed after the headers, when the server rejects
+      HEAD (405 or 501) or is listed in options["head_bad_hosts"].
+      otherwise it sends a plain GET.
+    """
+    if options["probe"] != "head":
+        reply=yield "GET",url,False,headers
+        return reply
+    if not host_in(url_host(url),options["head_bad_hosts"]):
+        reply=yield "HEAD",url,False,headers
+        if reply[0] != 405 and reply[0] != 501:
+            return reply
+    reply=yield "GET",url,True,headers
+    return reply
+
+def check_plan(url,options,validators=None):
+    """
+      it describes the HTTP requests needed to test url (PURLs are
+      resolved before, see PurlResolver).
+      check_plan is a generator: it yields the requests (see probe) and
+      receives (status_code,headers,bytes) of the response; the engine
+      that runs the plan performs the actual request.
+      validators are the headers of a conditional request for url.
+      it returns (return_code,description) when the URL failed or None
+      when the URL is OK (a 304 answer to a conditional request is OK).
+    """
+    status,headers,size=yield from probe(url,options,validators)
+    if options["max_redirects"] > 0:
+        status=yield from follow_redirects(url,status,headers,options)
+        if not isinstance(status,int):
+            return status
+    if status > 399:
+        return str(status),""
+    return None
+
+## statuses of the redirects that follow_redirects follows.
+redirect_statuses=(301,302,303,307,308)
+
+def follow_redirects(url,status,headers,options):
+    """
+      it follows the redirects of the reply (status,headers) to url, up
+      to options["max_redirects"] hops, and returns the status of the
+      last reply, or (return_code,description) for a redirect loop (613)
+      or a longer chain (612). a redirect without a Location header ends
+      the chain with its own status.
+      the hops are kept in options["redirect_cache"], shared by the run:
+      normalized URL -> (status,Location or ""), so the hops shared by
+      several chains are requested once (or a few times, by the chains
+      in flight when the hop is first requested).
+    """
+    redirect_cache=options["redirect_cache"]
+    visited=set([normalize_url(url)])
+    hops=0
+    while status in redirect_statuses:
+        location=headers.get("Location")
+        if location is None:
+            break
+        url=urljoin(url,location)
+        key=normalize_url(url)
+        if key in visited:
+            return "613",error_description["613"]
+        hops+=1
+        if hops > options["max_redirects"]:
+            return "612",error_description["612"]
+        visited.add(key)
+        hop=redirect_cache.get(key)
+        if hop is not None:
+            status,location=hop
+            headers={"Location":location} if location != "" else {}
+            continue
+        status,headers,size=yield from probe(url,options)
+        redirect_cache[key]=(status,headers.get("Location",""))
+    return status
+
+class CountingAdapter(requests.adapters.HTTPAdapter):
+    """
+       an HTTPAdapter that keeps count of the connections opened and of
+       the requests made by its connection pools, including the pools
+       that the pool manager discards when it holds more than
+       pool_connections hosts.
+    """
+    def init_poolmanager(self,*args,**kwargs):
+        requests.adapters.HTTPAdapter.init_poolmanager(self,*args,**kwargs)
+        self.retired_connections=0
+        self.retired_requests=0
+        self.poolmanager.pools.dispose_func=self.retire_pool
+
+    def retire_pool(self,pool):
+        self.retired_connections+=pool.num_connections
+        self.retired_requests+=pool.num_requests
+        pool.close()
+
+    def pool_counters(self):
+        """
+           it returns (connections opened, requests made).
+        """
+        connections=self.retired_connections
+        requests_made=self.retired_requests
+        pools=self.poolmanager.pools
+        for key in pools.keys():
+            pool=pools.get(key)
+            if pool is not None:
+                connections+=pool.num_connections
+                requests_made+=pool.num_requests
+        return connections,requests_made
+
+def new_session(options):
+    """
+       it returns a requests session whose connections stay open
+       (keep-alive) and are reused for later requests to the same host,
+       so the TCP and TLS handshakes happen once per pooled connection.
+       options["pool_connections"] is the number of hosts with a pool;
+       options["pool_maxsize"] is the number of connections per host.
+    """
+    session=requests.Session()
+    adapter=CountingAdapter(pool_connections=options["pool_connections"],
+                            pool_maxsize=options["pool_maxsize"])
+    session.mount("http://",adapter)
+    session.mount("https://",adapter)
+    return session,adapter
+
+def add_counters(counters,*values):
+    """
+      it adds the counters of a worker to the run counters, a shared array:
+      [connections opened, requests made, URLs tested, bytes transferred,
+      URLs inferred by the circuit breaker, URLs tested again (see
+      RetryQueue), URLs healthy when tested again].
+    """
+    with counters.get_lock():
+        for k in range(len(values)):
+            counters[k]+=values[k]
+    return
+
+## the answers of the DNS pre-resolution stage: hostname -> list of
+## (family,address), or None when the hostname doesn't exist.
+dns_cache={}
+real_getaddrinfo=socket.getaddrinfo
+
+def resolve_host(hostname):
+    """
+      it returns (hostname,addresses): addresses is a list of
+      (family,address) for hostname, None when the hostname doesn't exist
+      or "" when the lookup failed for another reason (e.g. a timeout).
+    """
+    try:
+        answer=real_getaddrinfo(hostname,None,0,socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        if e.errno == socket.EAI_NONAME or e.errno == getattr(socket,"EAI_NODATA",None):
+            return hostname,None
+        return hostname,""
+    except (UnicodeError,OSError):
+        return hostname,""
+    addresses=[]
+    for family,type,proto,canonname,sockaddr in answer:
+        if (family,sockaddr[0]) not in addresses:
+            addresses.append((family,sockaddr[0]))
+    return hostname,addresses
+
+def resolve_hosts(items,workers):
+    """
+      it resolves the distinct hostnames of the http and https URLs of the
+      (url,lines,validators) items (see resolve_hostnames).
+    """
+    hostnames=set()
+    for item in items:
+        hostnames.add(http_host(item[0]))
+    return resolve_hostnames(hostnames,workers)
+
+def resolve_hostnames(hostnames,workers):
+    """
+      it resolves hostnames concurrently, with up to workers lookups at a
+      time, and returns the answers for dns_cache. failed lookups that
+      are not "unknown hostname" are left out, so the request tries again.
+    """
+    hostnames=[hostname for hostname in hostnames if hostname != ""]
+    answers={}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for hostname,addresses in executor.map(resolve_host,hostnames):
+            if addresses != "":
+                answers[hostname]=addresses
+    return answers
+
+def cached_getaddrinfo(host,port,family=0,type=0,proto=0,flags=0):
+    """
+      socket.getaddrinfo that answers from dns_cache: a cached hostname
+      is turned into its numeric addresses without a DNS query.
+    """
+    key=host
+    if isinstance(key,bytes):
+        key=key.decode("ascii","replace")
+    if isinstance(key,str):
+        key=key.lower()
+    if key not in dns_cache:
+        return real_getaddrinfo(host,port,family,type,proto,flags)
+    addresses=dns_cache[key]
+    if addresses is None:
+        raise socket.gaierror(socket.EAI_NONAME,"Name or service not known")
+    answer=[]
+    for address_family,address in addresses:
+        if family != 0 and family != address_family:
+            continue
+        answer.extend(real_getaddrinfo(address,port,address_family,type,proto,
+                                       flags | socket.AI_NUMERICHOST))
+    if len(answer) == 0:
+        raise socket.gaierror(socket.EAI_NONAME,"Name or service not known")
+    return answer
+
+def install_dns_cache(answers):
+    """
+      it loads the answers of resolve_hosts into dns_cache and makes the
+      socket module use them.
+    """
+    dns_cache.update(answers)
+    socket.getaddrinfo=cached_getaddrinfo
+    return
+
+def unknown_host(url):
+    """
+      it returns True when the DNS pre-resolution found that the hostname
+      of url doesn't exist.
+    """
+    hostname=http_host(url)
+    return hostname in dns_cache and dns_cache[hostname] is None
+
+class PurlResolver(object):
+    """
+       the PURL resolution stage. the URLs on hosts (see purl_resolvers)
+       are replaced by the target of their redirect before dedupe, so a
+       target shared by several PURLs is tested once. up to workers PURLs
+       are resolved at a time, which also limits the requests to the PURL
+       server. the targets are memoized for the run and, with cache (a
+       ResultCache), kept between runs for ttl seconds.
+       a PURL that doesn't redirect is tested as it is.
+    """
+    def __init__(self,hosts,timer,workers,cache=None,ttl=0):
+        self.hosts=hosts
+        self.timer=timer
+        self.workers=workers
+        self.cache=cache
+        self.ttl=ttl
+        self.memo={}
+        self.local=threading.local()
+        self.resolved=0
+        self.memo_hits=0
+
+    def resolver(self,url):
+        """
+          it returns (use https,unwrap EZproxy) for url or None when url
+          is not a PURL.
+        """
+        hostname=url_host(url)
+        if not host_in(hostname,self.hosts):
+            return None
+        return purl_resolvers.get(hostname,(False,False))
+
+    def resolve(self,url):
+        """
+          it returns (target,final) for url: final is False when the
+          target can't be kept between runs (the PURL didn't redirect or
+          didn't answer). it runs in the threads of the stage.
+        """
+        use_https,unwrap=self.resolver(url)
+        purl=url
+        if use_https and url.lower().startswith("http:"):
+            purl="https:"+url[5:]
+        session=getattr(self.local,"session",None)
+        if session is None:
+            session=requests.Session()
+            self.local.session=session
+        try:
+            response=session.get(purl,timeout=int(self.timer),allow_redirects=False,stream=True)
+            response.close()
+        except Exception:
+            return url,False
+        location=response.headers.get("Location")
+        if response.status_code not in (301,302,303,307,308) or location is None:
+            return purl,False
+        target=urljoin(purl,location)
+        if unwrap:
+            mezp=ezproxy.match(target)
+            if mezp:
+                target=mezp.group(1)
+        return target,True
+
+    def target(self,executor,url):
+        """
+          it returns the memoized target of url, or the future that
+          resolves it.
+        """
+        key=normalize_url(url)
+        if key in self.memo:
+            self.memo_hits+=1
+            return self.memo[key]
+        if self.cache is not None:
+            row=self.cache.get_target(url)
+            if row is not None and time.time()-row[1] < self.ttl:
+                self.memo_hits+=1
+                self.memo[key]=row[0]
+                return row[0]
+        self.resolved+=1
+        future=executor.submit(self.resolve,url)
+        self.memo[key]=future
+        return future
+
+    def finish(self,url,future):
+        target,final=future.result()
+        key=normalize_url(url)
+        if self.memo.get(key) is future:
+            self.memo[key]=target
+            if final and self.cache is not None:
+                self.cache.put_target(url,target)
+        return target
+
+    def items(self,items):
+        """
+          it yields the (url,...) items of items with the URL of each PURL
+          replaced by its target; the other items pass through at once.
+        """
+        pending=deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for item in items:
+                if self.resolver(item[0]) is None:
+                    yield item
+                    continue
+                pending.append((self.target(executor,item[0]),item))
+                while len(pending) > 0:
+                    target,item=pending[0]
+                    if isinstance(target,Future):
+                        if len(pending) < 4*self.workers and not target.done():
+                            break
+                        target=self.finish(item[0],target)
+                    pending.popleft()
+                    yield (target,)+tuple(item[1:])
+            while len(pending) > 0:
+                target,item=pending.popleft()
+                if isinstance(target,Future):
+                    target=self.finish(item[0],target)
+                yield (target,)+tuple(item[1:])
+
+class HostBreaker(object):
+    """
+       the per-host circuit breaker shared by the worker processes; a host
+       is "hostname:port" (see url_server).
+       after threshold consecutive failures of a host (timeouts or failed
+       connections, see breaker_codes) the breaker opens: the URLs of the
+       host get the last error type without a request for cooldown
+       seconds. then up to probes requests go through; the first one that
+       gets an HTTP response closes the breaker, a failure opens it again.
+       a host owns one of size slots (by crc32); a host whose slot is
+       owned by another failing host is not protected by the breaker.
+    """
+    def __init__(self,threshold,cooldown,probes,size=16384):
+        self.threshold=threshold
+        self.cooldown=cooldown
+        self.probes=probes
+        self.owner=Array('L',size)
+        # the other arrays are protected by the lock of owner.
+        self.failures=Array('i',size,lock=False)
+        self.open_until=Array('d',size,lock=False)
+        self.probing=Array('i',size,lock=False)
+        self.last_code=Array('i',size,lock=False)
+
+    def slot(self,hostname):
+        key=zlib.crc32(hostname.encode("utf-8"))
+        # 0 marks a free slot.
+        return key % len(self.owner),key or 1
+
+    def check(self,hostname):
+        """
+          it returns None when a request to hostname may go ahead, or
+          the error type to infer when the breaker of hostname is open.
+        """
+        k,key=self.slot(hostname)
+        with self.owner.get_lock():
+            if self.owner[k] != key or self.open_until[k] == 0:
+                return None
+            if time.time() < self.open_until[k]:
+                return str(self.last_code[k])
+            if self.probing[k] < self.probes:
+                self.probing[k]+=1
+                return None
+            return str(self.last_code[k])
+
+    def record(self,hostname,return_code):
+        """
+          it records the result of a request to hostname: return_code is
+          the 6XX error type or None when the host answered.
+        """
+        k,key=self.slot(hostname)
+        failed=return_code in breaker_codes
+        with self.owner.get_lock():
+            if self.owner[k] != key:
+                busy=self.failures[k] > 0 or self.open_until[k] > 0
+                if not failed or (self.owner[k] != 0 and busy):
+                    return
+                self.owner[k]=key
+                self.failures[k]=0
+                self.open_until[k]=0
+            if not failed:
+                self.owner[k]=0
+                self.failures[k]=0
+                self.open_until[k]=0
+                self.probing[k]=0
+                return
+            self.failures[k]+=1
+            self.last_code[k]=int(return_code)
+            if self.open_until[k] > 0 or self.failures[k] >= self.threshold:
+                self.open_until[k]=time.time()+self.cooldown
+                self.probing[k]=0
+        return
+
+## error types that count as failures of the host for the circuit breaker.
+breaker_codes=("603","605","610")
+
+## the upper bounds, in seconds, of the buckets of the request latency
+## histograms (the last bucket is +Inf).
+latency_buckets=(0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0)
+
+class RunMetrics(object):
+    """
+       the instrumentation of a run.
+       codes counts the tested URLs by return code (0: healthy) and gauges
+       holds [URLs in flight, requests in flight, URLs waiting to be tested
+       again]; both are shared by the worker processes.
+       hosts holds the requests made by this process per host (see
+       url_server): [requests, failed requests, seconds, then the counts
+       of the latency_buckets and +Inf]. the worker processes save theirs
+       in metrics_NNNN when they finish and the main process merges them
+       (see save_hosts and load_hosts).
+       phases holds the seconds of each phase of the main process: ingest,
+       dispatch (handing the URLs to the engine, within check), check,
+       collate and mail.
+       the object goes to the worker processes with the options, so it
+       holds no thread state: the reporter is the main process's (see
+       start_reporter).
+    """
+    def __init__(self):
+        self.gauges=Array('l',3)
+        # codes is protected by the lock of gauges.
+        self.codes=Array('l',1000,lock=False)
+        self.hosts={}
+        self.phases={}
+        self.phase_name=None
+        self.phase_start=0
+        self.start=time.time()
+        self.url_total=0
+
+    def phase(self,name):
+        """
+          it ends the current phase and starts name (None: no phase).
+        """
+        now=time.time()
+        if self.phase_name is not None:
+            self.add_phase(self.phase_name,now-self.phase_start)
+        self.phase_name=name
+        self.phase_start=now
+        return
+
+    def add_phase(self,name,seconds):
+        self.phases[name]=self.phases.get(name,0)+seconds
+        return
+
+    def url_started(self,again=False):
+        with self.gauges.get_lock():
+            self.gauges[0]+=1
+            if again:
+                self.gauges[2]-=1
+        return
+
+    def url_deferred(self):
+        with self.gauges.get_lock():
+            self.gauges[0]-=1
+            self.gauges[2]+=1
+        return
+
+    def url_done(self,return_code):
+        k=min(int(return_code),999) if return_code is not None else 0
+        with self.gauges.get_lock():
+            self.gauges[0]-=1
+            self.codes[k]+=1
+        return
+
+    def request_started(self):
+        with self.gauges.get_lock():
+            self.gauges[1]+=1
+        return time.time()
+
+    def request_done(self,hostname,started,failed):
+        seconds=time.time()-started
+        with self.gauges.get_lock():
+            self.gauges[1]-=1
+        host=self.hosts.get(hostname)
+        if host is None:
+            host=[0,0,0.0]+[0]*(len(latency_buckets)+1)
+            self.hosts[hostname]=host
+        host[0]+=1
+        if failed:
+            host[1]+=1
+        host[2]+=seconds
+        k=0
+        while k < len(latency_buckets) and seconds > latency_buckets[k]:
+            k+=1
+        host[3+k]+=1
+        return
+
+    def save_hosts(self,path):
+        with open(path,"w") as metrics_f:
+            json.dump(self.hosts,metrics_f)
+        return
+
+    def load_hosts(self,path):
+        """
+          it adds the hosts saved in path to hosts and deletes path.
+        """
+        try:
+            with open(path,"r") as metrics_f:
+                saved=json.load(metrics_f)
+            os.unlink(path)
+        except (OSError,ValueError):
+            return
+        for hostname in saved:
+            host=self.hosts.get(hostname)
+            if host is None:
+                self.hosts[hostname]=saved[hostname]
+            else:
+                for k in range(len(host)):
+                    host[k]+=saved[hostname][k]
+        return
+
+    def tested(self):
+        with self.gauges.get_lock():
+            codes=self.codes[:]
+        return sum(codes),sum(codes)-codes[0]
+
+    def progress_line(self):
+        elapsed=time.time()-self.start
+        tested,failed=self.tested()
+        line="progress: "+str(tested)
+        if self.url_total > 0:
+            line+=" of "+str(self.url_total)
+        return (line+" URLs tested ("+'{:.1f}'.format(tested/max(elapsed,0.001))+"/s), "+
+                str(failed)+" failed, in flight: "+str(self.gauges[0])+" URLs "+
+                str(self.gauges[1])+" requests, waiting to be tested again: "+
+                str(self.gauges[2])+" URLs, phase: "+str(self.phase_name)+
+                ", "+str(int(elapsed))+" s")
+
+    def prometheus(self,counters,host_count):
+        """
+          it returns the metrics in the Prometheus text format; the
+          per-host metrics are those of the host_count hosts with the
+          most requests.
+        """
+        lines=["# TYPE check_url_start_time_seconds gauge",
+               "check_url_start_time_seconds "+'{:.3f}'.format(self.start),
+               "# TYPE check_url_phase_seconds gauge"]
+        phases=dict(self.phases)
+        if self.phase_name is not None:
+            phases[self.phase_name]=phases.get(self.phase_name,0)+time.time()-self.phase_start
+        for name in sorted(phases):
+            lines.append('check_url_phase_seconds{phase="'+name+'"} '+'{:.3f}'.format(phases[name]))
+        lines.append("# TYPE check_url_urls_tested_total counter")
+        with self.gauges.get_lock():
+            codes=self.codes[:]
+            gauges=self.gauges[:]
+        for k in range(len(codes)):
+            if codes[k] > 0:
+                code=str(k) if k > 0 else "ok"
+                lines.append('check_url_urls_tested_total{code="'+code+'"} '+str(codes[k]))
+        lines.append("# TYPE check_url_in_flight gauge")
+        lines.append('check_url_in_flight{kind="urls"} '+str(gauges[0]))
+        lines.append('check_url_in_flight{kind="requests"} '+str(gauges[1]))
+        lines.append("# TYPE check_url_retry_waiting gauge")
+        lines.append("check_url_retry_waiting "+str(gauges[2]))
+        names=("connections_opened","requests_made","urls_finished","bytes_transferred",
+               "urls_inferred","urls_retried","urls_recovered")
+        for k in range(len(names)):
+            lines.append("# TYPE check_url_"+names[k]+"_total counter")
+            lines.append("check_url_"+names[k]+"_total "+str(counters[k]))
+        busiest=sorted(self.hosts.items(),key=lambda entry: -entry[1][0])[:host_count]
+        lines.append("# TYPE check_url_host_requests_total counter")
+        for hostname,host in busiest:
+            lines.append('check_url_host_requests_total{host="'+prometheus_label(hostname)+'"} '+str(host[0]))
+        lines.append("# TYPE check_url_host_failed_requests_total counter")
+        for hostname,host in busiest:
+            lines.append('check_url_host_failed_requests_total{host="'+prometheus_label(hostname)+'"} '+str(host[1]))
+        lines.append("# TYPE check_url_host_request_seconds histogram")
+        for hostname,host in busiest:
+            label='host="'+prometheus_label(hostname)+'"'
+            count=0
+            for k in range(len(latency_buckets)):
+                count+=host[3+k]
+                lines.append("check_url_host_request_seconds_bucket{"+label+',le="'+
+                             str(latency_buckets[k])+'"} '+str(count))
+            lines.append("check_url_host_request_seconds_bucket{"+label+',le="+Inf"} '+str(host[0]))
+            lines.append("check_url_host_request_seconds_sum{"+label+"} "+'{:.3f}'.format(host[2]))
+            lines.append("check_url_host_request_seconds_count{"+label+"} "+str(host[0]))
+        return "\n".join(lines)+"\n"
+
+    def write_textfile(self,path,counters,host_count):
+        """
+          it replaces path with the Prometheus metrics, for the textfile
+          collector of node_exporter.
+        """
+        try:
+            with open(path+".tmp","w") as metrics_f:
+                metrics_f.write(self.prometheus(counters,host_count))
+            os.replace(path+".tmp",path)
+        except OSError as e:
+            sys.stderr.write("**ERR: couldn't write metrics "+path+": "+str(e)+"\n")
+        return
 
-   msg['Subject'] = subject
-   msg['From'] = from_mail
-   msg['To'] = recipients
-   try:
-      s = smtplib.SMTP(smtp_server,timeout=10)
-   except:
-      sys.stderr.write("**ERROR: couldn't connect to smptp server\n")
-      return 1
-   s.sendmail(from_mail, email_list, msg.as_string())
-   s.quit()
-   return 0
+    def start_reporter(self,interval,textfile,counters,host_count,print_lock):
+        """
+          every interval seconds, a thread writes the progress line to
+          stderr and, when textfile is not "", the Prometheus metrics.
+          it returns the event that stops the thread.
+        """
+        stop=threading.Event()
+
+        def report():
+            while not stop.wait(interval):
+                with print_lock:
+                    sys.stderr.write(self.progress_line()+"\n")
+                    sys.stderr.flush()
+                if textfile != "":
+                    self.write_textfile(textfile,counters,host_count)
+
+        reporter=threading.Thread(target=report)
+        reporter.daemon=True
+        reporter.start()
+        return stop
+
+    def summary(self,counters,run_info):
+        """
+          it returns the run summary: run_info, the phases, the URLs by
+          return code, the run counters and the hosts, slowest (most
+          seconds waiting on requests) first.
+        """
+        elapsed=time.time()-self.start
+        with self.gauges.get_lock():
+            codes=self.codes[:]
+        summary=dict(run_info)
+        summary["start"]=time.strftime("%Y-%m-%dT%H:%M:%S",time.localtime(self.start))
+        summary["seconds"]=round(elapsed,3)
+        summary["urls_per_second"]=round(sum(codes)/max(elapsed,0.001),1)
+        summary["phases"]=dict((name,round(self.phases[name],3)) for name in self.phases)
+        summary["codes"]=dict((str(k) if k > 0 else "ok",codes[k]) for k in range(len(codes)) if codes[k] > 0)
+        summary["connections_opened"]=counters[0]
+        summary["requests_made"]=counters[1]
+        summary["bytes_transferred"]=counters[3]
+        summary["urls_inferred"]=counters[4]
+        summary["urls_retried"]=counters[5]
+        summary["urls_recovered"]=counters[6]
+        hosts=[]
+        for hostname,host in sorted(self.hosts.items(),key=lambda entry: -entry[1][2]):
+            hosts.append({"host":hostname,"requests":host[0],"failed":host[1],
+                          "seconds":round(host[2],3),
+                          "mean_seconds":round(host[2]/max(host[0],1),3),
+                          "p90_seconds":histogram_bound(host,0.9)})
+        summary["hosts"]=hosts
+        return summary
+
+def prometheus_label(value):
+    return value.replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+
+def histogram_bound(host,fraction):
+    """
+      it returns the upper bound of the latency bucket of host (see
+      RunMetrics) that holds the given fraction of its requests, or
+      None for the +Inf bucket.
+    """
+    count=0
+    for k in range(len(latency_buckets)):
+        count+=host[3+k]
+        if count >= fraction*host[0]:
+            return latency_buckets[k]
+    return None
+
+class Outcome(object):
+    """
+       the outcome of testing one URL.
+       return_code is None when the URL is OK, otherwise the HTTP status
+       or the 6XX error type, with its description. note is "inferred"
+       when the error type comes from the circuit breaker of the host.
+       size is the number of bytes of the responses. etag and
+       last_modified are the validators of the last response, kept by the
+       result cache. final_url is the URL of the last request, started the
+       time of the first one and latency the seconds of the whole test.
+    """
+    __slots__=("return_code","description","note","size","etag","last_modified",
+               "final_url","started","latency")
+
+    def __init__(self):
+        self.return_code=None
+        self.description=""
+        self.note=""
+        self.size=0
+        self.etag=None
+        self.last_modified=None
+        self.final_url=None
+        self.started=time.time()
+        self.latency=0
+
+    def details(self):
+        """
+          it returns (latency,bytes,final_url,started) for the result
+          records (see result_record).
+        """
+        return round(self.latency,3),self.size,self.final_url,int(self.started)
+
+def inferred_outcome(outcome,return_code):
+    """
+      it completes outcome with the error type inferred by the circuit
+      breaker.
+    """
+    outcome.return_code=return_code
+    outcome.description=error_description.get(return_code,"")
+    outcome.note="inferred"
+    outcome.latency=time.time()-outcome.started
+    return outcome
+
+def finish_outcome(outcome,result,reply,validators):
+    """
+      it completes outcome with the result returned by check_plan and
+      the validators of the last reply. a 304 reply keeps the validators
+      of the conditional request.
+    """
+    if result is not None:
+        outcome.return_code,outcome.description=result
+    outcome.latency=time.time()-outcome.started
+    if reply is None:
+        return outcome
+    status,headers,size=reply
+    outcome.etag=headers.get("ETag")
+    outcome.last_modified=headers.get("Last-Modified")
+    if status == 304 and validators:
+        if outcome.etag is None:
+            outcome.etag=validators.get("If-None-Match")
+        if outcome.last_modified is None:
+            outcome.last_modified=validators.get("If-Modified-Since")
+    return outcome
+
+def check_url(session,url,options,validators=None,hold=None):
+    """
+      it runs check_plan for url with a requests session and returns
+      its Outcome. the timeouts of each request come from
+      request_timeouts. with hold (a HostHold), each request waits for
+      the slot of its host, redirect hops included.
+    """
+    outcome=Outcome()
+    reply=None
+    breaker=options["breaker"]
+    metrics=options["metrics"]
+    timeouts=options["timeouts"]
+    hostname=None
+    started=None
+    plan=check_plan(url,options,validators)
+    try:
+        method,target,stream,headers=next(plan)
+        while True:
+            outcome.final_url=target
+            if unknown_host(target):
+                return finish_outcome(outcome,("603",error_description["603"]),None,None)
+            hostname=url_server(target)
+            if breaker is not None:
+                return_code=breaker.check(hostname)
+                if return_code is not None:
+                    return inferred_outcome(outcome,return_code)
+            if hold is not None:
+                hold.move(url_host(target))
+            if metrics is not None:
+                started=metrics.request_started()
+            response=session.request(method,target,headers=headers,
+                                     timeout=request_timeouts(hostname,options),
+                                     allow_redirects=False,stream=stream)
+            if breaker is not None:
+                breaker.record(hostname,None)
+            if timeouts is not None:
+                timeouts.answered(hostname,response.elapsed.total_seconds())
+            if stream:
+                # close the connection without reading the body.
+                response.close()
+                body_size=0
+            else:
+                body_size=len(response.content)
+            if started is not None:
+                metrics.request_done(hostname,started,False)
+                started=None
+            reply=(response.status_code,response.headers,
+                   response_size(response.raw.headers,body_size))
+            outcome.size+=reply[2]
+            method,target,stream,headers=plan.send(reply)
+    except StopIteration as stop:
+        return finish_outcome(outcome,stop.value,reply,validators)
+    except Exception as e:
+        return_code=classify_exception(e)
+        if started is not None:
+            metrics.request_done(hostname,started,True)
+        if timeouts is not None and hostname is not None and return_code == "605":
+            timeouts.timed_out(hostname)
+        if breaker is not None and hostname is not None:
+            breaker.record(hostname,return_code)
+        return finish_outcome(outcome,(return_code,error_description[return_code]),None,None)
+
+## the transient error types that are tested again after the first pass
+## over the input (see RetryQueue).
+retry_codes=("500","503","605","610")
+
+class RetryQueue(object):
+    """
+       the URLs of a worker whose test got a transient error (retry_codes).
+       they are tested again after the first pass over the input, so they
+       don't hold up the other URLs: a URL is due delay seconds after its
+       failure, twice as long after each new failure, for up to retries
+       more tests. the run tests at most budget URLs again (the budget is
+       shared by the worker processes). URLs inferred by the circuit
+       breaker are not tested again.
+       a URL that still fails after several tests gets the note "N attempts".
+    """
+    def __init__(self,retries,delay,budget):
+        self.retries=retries
+        self.delay=delay
+        self.budget=Array('l',[budget])
+        # pending and attempts belong to each worker.
+        self.pending=[]
+        self.attempts={}
+        self.sequence=0
 
+    def attempt(self,url):
+        """
+          it returns the number of the test of url about to start (1: the
+          first pass).
+        """
+        return self.attempts.get(url,0)+1
 
-def report_URL(mms_id,resource_type,target,email_body):
+    def defer(self,item,outcome):
+        """
+          it returns True and keeps item (url,lines,validators) for
+          another test when outcome is a transient error that may be
+          tested again; otherwise outcome is final.
+        """
+        url=item[0]
+        attempt=self.attempt(url)
+        transient=(outcome.return_code in retry_codes and outcome.note == "" and
+                   attempt <= self.retries)
+        if transient:
+            with self.budget.get_lock():
+                transient=self.budget[0] > 0
+                if transient:
+                    self.budget[0]-=1
+        if not transient:
+            self.attempts.pop(url,None)
+            if attempt > 1 and outcome.return_code is not None and outcome.note == "":
+                outcome.note=str(attempt)+" attempts"
+            return False
+        self.attempts[url]=attempt
+        self.sequence+=1
+        heapq.heappush(self.pending,(time.time()+self.delay*2**(attempt-1),self.sequence,item))
+        return True
+
+    def wait(self):
+        """
+          it returns the seconds until the next URL is due.
+        """
+        return max(self.pending[0][0]-time.time(),0)
+
+    def due(self):
+        """
+          it returns the items that are due.
+        """
+        items=[]
+        now=time.time()
+        while len(self.pending) > 0 and self.pending[0][0] <= now:
+            items.append(heapq.heappop(self.pending)[2])
+        return items
+
+def queued_items(work_queue):
+    """
+      it yields the (url,lines,validators) items of the batches taken
+      from work_queue until it receives None.
     """
-        it adds a string with results to the email_body list identified
-        by the resource type (typically ALMA bib or ALMA portfolio )
+    while True:
+        batch=work_queue.get()
+        if batch is None:
+            return
+        for item in batch:
+            yield item
+
+def test_failed(results,url,lines,error,lock):
+    """
+      it reports an unexpected exception raised while url was tested and
+      gives its lines 608, so they still get a result; the worker goes
+      on with the next URL.
     """
-    email_body[int(resource_type)]+=target+" mms_id: "+str(mms_id)+"\n"
+    with lock:
+        sys.stderr.write("**ERROR "+str(url)+": "+repr(error)+"\n")
+    try:
+        results.result(lines,"608",error_description["608"],"")
+    except Exception as e:
+        with lock:
+            sys.stderr.write("**ERR: couldn't write the result of "+str(url)+": "+repr(e)+"\n")
     return
 
-def decode_message(message):
-       """
-          message is the string produced by an HTTP  exception.
-          the function parses the message to extract an error type.
-          the error type is encoded as 6XX ( a local convention).
-       """
-       hostname=re.compile(".*(Failed to establish a new).*")
-       my_timeout=re.compile(".*( Read timed out).*")
-       no_protocol=re.compile(".*(No connection adapters).*")
-       no_scheme=re.compile(".*(No schema supplied).*")
-       no_connection=re.compile(".*(Connection to ).*(timed out).*")
-       s=hostname.search(message)
-       if s:
-          return "603"
-       s=my_timeout.search(message)
-       if s:
-          return "605"
-       s=no_protocol.search(message)
-       if s:
-          return "607"
-       s=no_scheme.search(message)
-       if s:
-          return "609"
-       s=no_connection.search(message)
-       if s:
-          return "610"
-       return "608"
-
-def process_file(number,directory,input_prefix,output_prefix,timer,exclusion):
-    """
-      this function opens the designated text file that contains the URLs
-      and invokes the GET method to test the URL.
+def host_limits(hostname,options):
+    """
+      it returns (max_in_flight,rate) for hostname: the most specific
+      entry of options["host_limits"] that matches the host or the
+      defaults host_max_in_flight and host_rate.
+      rate is in requests per second; 0 means no limit.
+    """
+    limits=(options["host_max_in_flight"],options["host_rate"])
+    matched=""
+    for domain,max_in_flight,rate in options["host_limits"]:
+        if len(domain) > len(matched) and host_in(hostname,[domain]):
+            matched=domain
+            limits=(max_in_flight,rate)
+    return limits
+
+def idle_marks(items,idle=0.5):
+    """
+      it yields the items of items, read in a thread, and None whenever no
+      item came for idle seconds, so the stages that hold items (see
+      interleave_hosts) pass them on while the input waits (streaming
+      mode). an exception of items is raised again here.
+    """
+    received=queue.Queue(maxsize=1000)
+    end=[]
+
+    def read():
+        try:
+            for item in items:
+                received.put((True,item))
+        except BaseException as e:
+            end.append(e)
+        received.put((False,None))
+
+    reader=threading.Thread(target=read,daemon=True)
+    reader.start()
+    while True:
+        try:
+            more,item=received.get(timeout=idle)
+        except Empty:
+            yield None
+            continue
+        if not more:
+            break
+        yield item
+    reader.join()
+    if len(end) > 0:
+        raise end[0]
+
+def interleave_hosts(items,window):
+    """
+      it yields the (url,lines) items of items in an order that alternates
+      between hosts: up to window items are kept grouped by host and the
+      hosts take turns, so the sorted input does not send a burst of
+      requests to one host. a None item (see idle_marks) makes it yield
+      the items it holds, then None.
+    """
+    pending={}
+    ready=deque()
+    count=0
+    for item in items:
+        if item is None:
+            while len(ready) > 0:
+                hostname=ready.popleft()
+                yield pending[hostname].popleft()
+                if len(pending[hostname]) > 0:
+                    ready.append(hostname)
+                else:
+                    del pending[hostname]
+            count=0
+            yield None
+            continue
+        hostname=url_host(item[0])
+        if hostname not in pending:
+            pending[hostname]=deque()
+            ready.append(hostname)
+        pending[hostname].append(item)
+        count+=1
+        if count < window:
+            continue
+        hostname=ready.popleft()
+        yield pending[hostname].popleft()
+        count-=1
+        if len(pending[hostname]) > 0:
+            ready.append(hostname)
+        else:
+            del pending[hostname]
+    while len(ready) > 0:
+        hostname=ready.popleft()
+        yield pending[hostname].popleft()
+        if len(pending[hostname]) > 0:
+            ready.append(hostname)
+        else:
+            del pending[hostname]
+
+class HostSlots(object):
+    """
+       per-host concurrency and rate limits shared by the worker processes.
+       a host is mapped to one of size shared counters by crc32; hosts that
+       share a counter also share its limits.
+    """
+    def __init__(self,size=4096):
+        self.in_flight=Array('i',size)
+        # next_time is protected by the lock of in_flight.
+        self.next_time=Array('d',size,lock=False)
+
+    def slot(self,hostname):
+        return zlib.crc32(hostname.encode("utf-8")) % len(self.in_flight)
+
+    def acquire(self,hostname,max_in_flight,rate):
+        """
+          it waits until hostname has less than max_in_flight requests in
+          flight and its rate allows another request.
+        """
+        k=self.slot(hostname)
+        while True:
+            with self.in_flight.get_lock():
+                now=time.time()
+                if (max_in_flight < 1 or self.in_flight[k] < max_in_flight) and self.next_time[k] <= now:
+                    self.in_flight[k]+=1
+                    if rate > 0:
+                        self.next_time[k]=now+1.0/rate
+                    return
+                wait=self.next_time[k]-now
+            time.sleep(min(max(wait,0.02),1.0))
+
+    def release(self,hostname):
+        k=self.slot(hostname)
+        with self.in_flight.get_lock():
+            self.in_flight[k]-=1
+        return
+
+class HostHold(object):
+    """
+       the host slot (see HostSlots) held by the test of a URL. the test
+       holds the slot of one host at a time: a request to another host (a
+       redirect hop) gives it up and waits for the slot of that host, so
+       the limits of every host apply and two tests never wait on each
+       other. the requests of a test to the same host take one slot.
+    """
+    def __init__(self,host_slots,options):
+        self.host_slots=host_slots
+        self.options=options
+        self.hostname=None
+
+    def move(self,hostname):
+        if hostname == self.hostname:
+            return
+        self.release()
+        max_in_flight,rate=host_limits(hostname,self.options)
+        self.host_slots.acquire(hostname,max_in_flight,rate)
+        self.hostname=hostname
+        return
+
+    def release(self):
+        if self.hostname is not None:
+            self.host_slots.release(self.hostname)
+            self.hostname=None
+        return
+
+class HostTimeouts(object):
+    """
+       the adaptive connect and read timeouts per host (see url_server),
+       shared by the worker processes.
+       the answer times of a host (until the response headers) give a
+       smoothed answer time and its variation, as the retransmission
+       timer of TCP: after min_samples answers the limit of the host is
+       srtt+4*rttvar, no less than minimum; before, the limits are
+       connect_timeout and read_timeout. each timeout (605) of the host
+       doubles its limits until it answers again. the connect limit is
+       never above connect_timeout, nor the read limit above maximum.
+       history holds the estimates of the previous runs (see
+       ResultCache.latencies): hostname -> (srtt,rttvar,samples).
+       a host is mapped to one of size slots by crc32; hosts that share
+       a slot also share the estimate.
+    """
+    def __init__(self,connect_timeout,read_timeout,minimum,maximum,history=None,
+                 min_samples=3,size=4096):
+        self.connect_timeout=connect_timeout
+        self.read_timeout=read_timeout
+        self.minimum=minimum
+        self.maximum=maximum
+        self.history=history or {}
+        self.min_samples=min_samples
+        self.samples=Array('i',size)
+        # the other arrays are protected by the lock of samples.
+        self.srtt=Array('d',size,lock=False)
+        self.rttvar=Array('d',size,lock=False)
+        self.backoff=Array('i',size,lock=False)
+        self.seeded=Array('b',size,lock=False)
+        # the hosts seen by this process (see save).
+        self.seen=set()
+
+    def slot(self,hostname):
+        return zlib.crc32(hostname.encode("utf-8")) % len(self.samples)
+
+    def limits(self,hostname):
+        """
+          it returns the (connect,read) timeouts, in seconds, of a
+          request to hostname.
+        """
+        k=self.slot(hostname)
+        self.seen.add(hostname)
+        with self.samples.get_lock():
+            if not self.seeded[k]:
+                self.seeded[k]=1
+                saved=self.history.get(hostname)
+                if saved is not None and self.samples[k] == 0:
+                    self.srtt[k],self.rttvar[k],self.samples[k]=saved
+            if self.samples[k] >= self.min_samples:
+                connect=read=max(self.minimum,self.srtt[k]+4*self.rttvar[k])
+            else:
+                connect,read=self.connect_timeout,self.read_timeout
+            factor=2**self.backoff[k]
+        return min(connect*factor,self.connect_timeout),min(read*factor,self.maximum)
+
+    def answered(self,hostname,seconds):
+        k=self.slot(hostname)
+        with self.samples.get_lock():
+            if self.samples[k] == 0:
+                self.srtt[k]=seconds
+                self.rttvar[k]=seconds/2
+            else:
+                self.rttvar[k]=0.75*self.rttvar[k]+0.25*abs(self.srtt[k]-seconds)
+                self.srtt[k]=0.875*self.srtt[k]+0.125*seconds
+            self.samples[k]+=1
+            self.backoff[k]=0
+        return
+
+    def timed_out(self,hostname):
+        k=self.slot(hostname)
+        with self.samples.get_lock():
+            self.backoff[k]=min(self.backoff[k]+1,4)
+        return
+
+    def save(self,path):
+        """
+          it keeps the estimates of the hosts seen by this process in the
+          result cache at path (see ResultCache) for the next run.
+        """
+        try:
+            cache=ResultCache(path)
+        except sqlite3.Error as e:
+            sys.stderr.write("**ERR: couldn't use cache "+path+": "+str(e)+"\n")
+            return
+        for hostname in self.seen:
+            k=self.slot(hostname)
+            with self.samples.get_lock():
+                estimate=(self.srtt[k],self.rttvar[k],self.samples[k])
+            if estimate[2] > 0:
+                cache.put_latency(hostname,*estimate)
+        cache.close()
+        return
+
+def request_timeouts(hostname,options):
+    """
+      it returns the (connect,read) timeouts of a request to hostname:
+      those of options["timeouts"] (a HostTimeouts) or the fixed ones.
+    """
+    if options["timeouts"] is not None:
+        return options["timeouts"].limits(hostname)
+    return options["connect_timeout"],options["read_timeout"]
+
+class HostScheduler(object):
+    """
+       the host-aware scheduler of the async engine. it keeps up to window
+       (url,lines) items grouped by host and hands them out in turns between
+       the hosts that are below their concurrency and rate limits (see
+       host_limits), so no coroutine waits on a busy host while other
+       hosts have work.
+    """
+    def __init__(self,options,window):
+        self.options=options
+        self.window=window
+        self.pending={}
+        self.in_flight={}
+        self.next_time={}
+        self.limits={}
+        self.ready=deque()
+        self.count=0
+        self.closed=False
+        self.changed=asyncio.Condition()
+
+    def host_limits(self,hostname):
+        if hostname not in self.limits:
+            self.limits[hostname]=host_limits(hostname,self.options)
+        return self.limits[hostname]
+
+    async def put(self,item):
+        async with self.changed:
+            while self.count >= self.window:
+                await self.changed.wait()
+            hostname=url_host(item[0])
+            if hostname not in self.pending:
+                self.pending[hostname]=deque()
+                self.in_flight.setdefault(hostname,0)
+                self.ready.append(hostname)
+            self.pending[hostname].append(item)
+            self.count+=1
+            self.changed.notify_all()
+
+    async def close(self):
+        async with self.changed:
+            self.closed=True
+            self.changed.notify_all()
+
+    def take(self):
+        """
+          it returns (hostname,item) for the next host that may get a
+          request, or (None,seconds to wait) when no host may.
+        """
+        wait=1.0
+        now=time.monotonic()
+        for k in range(len(self.ready)):
+            hostname=self.ready.popleft()
+            max_in_flight,rate=self.host_limits(hostname)
+            if max_in_flight > 0 and self.in_flight[hostname] >= max_in_flight:
+                # done() puts the host back in turn.
+                continue
+            if self.next_time.get(hostname,0) > now:
+                wait=min(wait,self.next_time[hostname]-now)
+                self.ready.append(hostname)
+                continue
+            item=self.pending[hostname].popleft()
+            self.count-=1
+            self.in_flight[hostname]+=1
+            if rate > 0:
+                self.next_time[hostname]=now+1.0/rate
+            if len(self.pending[hostname]) > 0:
+                self.ready.append(hostname)
+            else:
+                del self.pending[hostname]
+            return hostname,item
+        return None,wait
+
+    async def get(self):
+        """
+          it returns (hostname,item) or None when all the items are gone.
+        """
+        async with self.changed:
+            while True:
+                hostname,item=self.take()
+                if hostname is not None:
+                    self.changed.notify_all()
+                    return hostname,item
+                if self.closed and self.count == 0:
+                    return None
+                try:
+                    await asyncio.wait_for(self.changed.wait(),item)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def acquire(self,hostname):
+        """
+          it waits until hostname is below its limits and counts a request
+          in flight to it, for the requests of a test that leave the host
+          of its URL (see SchedulerHold); done releases it.
+        """
+        max_in_flight,rate=self.host_limits(hostname)
+        async with self.changed:
+            while True:
+                now=time.monotonic()
+                in_flight=self.in_flight.get(hostname,0)
+                wait=self.next_time.get(hostname,0)-now
+                if (max_in_flight < 1 or in_flight < max_in_flight) and wait <= 0:
+                    self.in_flight[hostname]=in_flight+1
+                    if rate > 0:
+                        self.next_time[hostname]=now+1.0/rate
+                    return
+                try:
+                    await asyncio.wait_for(self.changed.wait(),min(max(wait,0.02),1.0))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def done(self,hostname):
+        async with self.changed:
+            self.in_flight[hostname]-=1
+            if hostname in self.pending and hostname not in self.ready:
+                self.ready.append(hostname)
+            if self.in_flight[hostname] == 0 and hostname not in self.pending:
+                del self.in_flight[hostname]
+                # an idle host keeps its next request time until it is due.
+                if self.next_time.get(hostname,0) <= time.monotonic():
+                    self.next_time.pop(hostname,None)
+            self.changed.notify_all()
+
+class SchedulerHold(object):
+    """
+       the host slot held by the test of a URL in the async engine, like
+       HostHold: it starts with the slot that HostScheduler.get took for
+       the host of the URL.
+    """
+    def __init__(self,scheduler,hostname):
+        self.scheduler=scheduler
+        self.hostname=hostname
+
+    async def move(self,hostname):
+        if hostname == self.hostname:
+            return
+        await self.release()
+        await self.scheduler.acquire(hostname)
+        self.hostname=hostname
+        return
+
+    async def release(self):
+        if self.hostname is not None:
+            hostname=self.hostname
+            self.hostname=None
+            await self.scheduler.done(hostname)
+        return
+
+def process_file(number,work_queue,directory,output_prefix,host_slots,options,counters,result_queue=None):
+    """
+      this function takes batches of URLs from the shared work queue
+      and invokes the GET method to test the URL. a process that gets
+      slow hosts simply takes fewer batches than the others.
+      in streaming mode (result_queue is not None) the results go to
+      the main process instead of the output file.
       parameters:
           number = the thread id (0,1..)
+          work_queue = queue with lists of (url,lines,validators); None ends the work.
           directory = work directory.
-          input_prefix =  part of the input file name.
           output_prefix  = part of the output file name.
-          timer = HTTP timeout.
-          exclusion = file with strings for URLs to ignore.
+          host_slots = per-host limits shared by the processes (HostSlots).
+          options = request settings (see new_session, host_limits and request_timeouts).
+          counters = shared array for the run counters (see add_counters).
+          result_queue = queue for the results (streaming mode) or None.
     """
-    delim="_|_"
     pause = random.randint(3,8)
-    # use lock when printing to standard output.
-    lock=Lock()
+    # the processes share the lock when they print to standard error.
+    lock=options["print_lock"]
+    metrics=options["metrics"]
     sequence='{:04d}'.format(int(number))
     output_file=directory+output_prefix+sequence
-    input_file=directory+input_prefix+sequence
-
-    try:
-        output_f=open(output_file,'w')
-    except:
-        lock.acquire()
-        print "failed to open "+output_file
-        lock.release()
-        return
-    try:
-        input_f=open(input_file,'r')
-    except:
-        lock.acquire()
-        print "failed to open "+input_file
-        lock.release()
-        return
-    ## resolve local PURLs. emoy libraries use pid.emory.edu
-    emory_pid=re.compile("(http|https)(://pid.emory.edu/)(.*)")
 
-    ## pid would containg an ezproxy URL. get ezproxy's target for testing.
-    ezproxy=re.compile(".*\?url=(.*)")
-
-    # use 'previous_url' to detect duplicate URLs.
-    previous_url="----"
-    try:
-     for i_line in input_f:
-        i_line=i_line.rstrip("\n")
+    output_f=None
+    if result_queue is not None:
+        results=QueueResults(result_queue)
+    else:
         try:
-            url,mms_id,record_type=i_line.split(delim)
+            output_f=open(output_file,'w')
         except:
-            sys.stderr.write("**ERROR: invalid input line.\n")
-            continue
-        skip_it=False
-        ## if URL contains an excluded string then
-        ## do not test the URL.
-        for x_string in exclusion:
-            if url.find(x_string) > -1:
-                skip_it=True
-                break
-        if skip_it:
-            continue
-        if url == previous_url:
-           continue
+            with lock:
+                sys.stderr.write("**ERR: failed to open "+output_file+"\n")
+            # drain the queue, so the main process doesn't wait on this worker.
+            for item in queued_items(work_queue):
+                pass
+            return
+        results=ResultWriter(RecordFile(output_f))
+
+    install_dns_cache(options["dns_cache"])
+    session,adapter=new_session(options)
+    cache=worker_cache(options["cache_file"],lock)
+    journal=None
+    if options["journal_file"] is not None:
+        journal=Journal(options["journal_file"]+sequence,options["journal_batch"])
+    retry=options["retry"]
+    # URLs tested, bytes transferred, URLs inferred, URLs tested again,
+    # URLs healthy when tested again (see add_counters).
+    tally=[0,0,0,0,0]
+    in_flight=False
+
+    def test(url,lines,validators):
+        nonlocal in_flight
         ####  ugly hack to allow HTTPS requests out of turing.
         #socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, "127.0.0.1", 8080)
         #socket.socket = socks.socksocket
         ####
-        previous_url=url
-        m=emory_pid.match(url)
-        if m:
-           if m.group(1) == "http":
-                new_emorypid="https"+m.group(2)+m.group(3)
-           else:
-                new_emorypid=url
-           try:
-              response = requests.get(new_emorypid, timeout=int(timer),allow_redirects=False)
-           except Exception as e:
-             message=str(e)
-             return_code=decode_message(message)
-             if return_code == "605":
-                output_f.write("HTTP/1.1_@_605_@_connection timed out_@__@_"+i_line+"\n")
-                continue
-             if return_code == "603":
-                output_f.write("HTTP/1.1_@_603_@_unknown hostname_@__@_"+i_line+"\n")
-                continue
-             if return_code == "607":
-                output_f.write("HTTP/1.1_@_607_@_unsupported HTTP protocol_@__@_"+i_line+"\n")
-                continue
-             if return_code == "609":
-                output_f.write("HTTP/1.1_@_609_@_Ill-formed URL_@__@_"+i_line+"\n")
-                continue
-             if return_code == "610":
-                output_f.write("HTTP/1.1_@_610_@_Connection to server failed_@__@_"+i_line+"\n")
-                continue
-             if return_code == "608":
-                output_f.write("HTTP/1.1_@_608_@_Unknown Python exception_@__@_"+i_line+"\n")
-                continue
-           status=response.status_code
-           if status == 301 or status == 302:
-#sys.stdout.write("HTTP/1.1_@_"+str(http_code)+"_@_"+str(description)+"_@_ _@_"+i_line+"\n")
-               headers=response.headers
-               redirection=headers["Location"]
-               mezp=ezproxy.match(redirection)
-               if mezp:
-                   url=mezp.group(1)
-           elif status > 399:
-              output_f.write("HTTP/1.1_@_"+str(status)+"_@_"+"_@_"+"_@_"+i_line+"\n")
-              continue
+        attempt=retry.attempt(url) if retry is not None else 1
+        hold=HostHold(host_slots,options)
+        hold.move(url_host(url))
+        if metrics is not None:
+            metrics.url_started(attempt > 1)
+            in_flight=True
+        try:
+            outcome=check_url(session,url,options,validators,hold)
+        finally:
+            hold.release()
+        tally[1]+=outcome.size
+        if attempt == 1:
+            tally[0]+=1
+        else:
+            tally[3]+=1
+        if retry is not None and retry.defer((url,lines,validators),outcome):
+            if metrics is not None:
+                metrics.url_deferred()
+                in_flight=False
+            return
+        if metrics is not None:
+            metrics.url_done(outcome.return_code)
+            in_flight=False
+        if attempt > 1 and outcome.return_code is None:
+            tally[4]+=1
+        if outcome.note == "inferred":
+            tally[2]+=1
+        if cache is not None:
+            cache.put(url,outcome)
+        if journal is not None:
+            journal.record(url,outcome)
+        # the result goes to every mms_id that references the URL.
+        results.result(lines,outcome.return_code,outcome.description,outcome.note,
+                       outcome.details())
+
+    def test_or_fail(url,lines,validators):
+        nonlocal in_flight
         try:
-            response = requests.get(url, timeout=int(timer),allow_redirects=False)
+            test(url,lines,validators)
         except Exception as e:
-            message=str(e)
-            return_code=decode_message(message)
-            if return_code == "605":
-                output_f.write("HTTP/1.1_@_605_@_connection timed out_@__@_"+i_line+"\n")
-                continue
-            if return_code == "603":
-                output_f.write("HTTP/1.1_@_603_@_unknown hostname_@__@_"+i_line+"\n")
-                continue
-            if return_code == "607":
-                output_f.write("HTTP/1.1_@_607_@_unsupported HTTP protocol_@__@_"+i_line+"\n")
-                continue
-            if return_code == "609":
-                output_f.write("HTTP/1.1_@_609_@_Ill-formed URL_@__@_"+i_line+"\n")
-                continue
-            if return_code == "610":
-                output_f.write("HTTP/1.1_@_610_@_Connection to server failed_@__@_"+i_line+"\n")
+            if in_flight:
+                metrics.url_done("608")
+                in_flight=False
+            test_failed(results,url,lines,e,lock)
+
+    for url,lines,validators in queued_items(work_queue):
+        test_or_fail(url,lines,validators)
+    # the URLs with transient errors are tested again once they are due.
+    while retry is not None and len(retry.pending) > 0:
+        time.sleep(retry.wait())
+        for url,lines,validators in retry.due():
+            test_or_fail(url,lines,validators)
+    connections,requests_made=adapter.pool_counters()
+    add_counters(counters,connections,requests_made,*tally)
+    if metrics is not None:
+        metrics.save_hosts(directory+"metrics_"+sequence)
+    if journal is not None:
+        journal.close()
+    if cache is not None:
+        cache.close()
+    if options["timeouts"] is not None and options["timeout_history"] is not None:
+        options["timeouts"].save(options["timeout_history"])
+    session.close()
+    if output_f is not None:
+        output_f.close()
+    else:
+        # tell the main process that this worker is done.
+        result_queue.put(None)
+    return
+
+async def check_url_async(session,url,options,validators=None,hold=None):
+    """
+      it runs check_plan for url with aiohttp and returns its Outcome,
+      like check_url; hold is a SchedulerHold.
+    """
+    outcome=Outcome()
+    reply=None
+    breaker=options["breaker"]
+    metrics=options["metrics"]
+    timeouts=options["timeouts"]
+    hostname=None
+    started=None
+    plan=check_plan(url,options,validators)
+    try:
+        method,target,stream,headers=next(plan)
+        while True:
+            outcome.final_url=target
+            if unknown_host(target):
+                return finish_outcome(outcome,("603",error_description["603"]),None,None)
+            hostname=url_server(target)
+            if breaker is not None:
+                return_code=breaker.check(hostname)
+                if return_code is not None:
+                    return inferred_outcome(outcome,return_code)
+            if hold is not None:
+                await hold.move(url_host(target))
+            if metrics is not None:
+                started=metrics.request_started()
+            connect,read=request_timeouts(hostname,options)
+            sent=time.time()
+            async with session.request(method,target,headers=headers,allow_redirects=False,
+                                       timeout=aiohttp.ClientTimeout(total=None,sock_connect=connect,
+                                                                     sock_read=read)) as response:
+                if breaker is not None:
+                    breaker.record(hostname,None)
+                if timeouts is not None:
+                    timeouts.answered(hostname,time.time()-sent)
+                if stream:
+                    # leaving the context without reading the body
+                    # closes the connection.
+                    body_size=0
+                else:
+                    # read the body, as requests does, so that the
+                    # connection goes back to the pool.
+                    body_size=len(await response.read())
+                if started is not None:
+                    metrics.request_done(hostname,started,False)
+                    started=None
+                reply=(response.status,response.headers,
+                       response_size(response.headers,body_size))
+            outcome.size+=reply[2]
+            method,target,stream,headers=plan.send(reply)
+    except StopIteration as stop:
+        return finish_outcome(outcome,stop.value,reply,validators)
+    except Exception as e:
+        return_code=classify_exception(e)
+        if started is not None:
+            metrics.request_done(hostname,started,True)
+        if timeouts is not None and hostname is not None and return_code == "605":
+            timeouts.timed_out(hostname)
+        if breaker is not None and hostname is not None:
+            breaker.record(hostname,return_code)
+        return finish_outcome(outcome,(return_code,error_description[return_code]),None,None)
+
+async def feed(scheduler,items):
+    """
+      it puts the items into scheduler. the items of a list are put at
+      once; the items of an iterator (stdin, PURL resolution) are read in
+      a thread, so the requests go on while the input waits.
+    """
+    if isinstance(items,list):
+        for item in items:
+            await scheduler.put(item)
+        return
+    loop=asyncio.get_running_loop()
+
+    def read():
+        for item in items:
+            asyncio.run_coroutine_threadsafe(scheduler.put(item),loop).result()
+
+    await loop.run_in_executor(None,read)
+
+async def process_file_async(items,results,max_in_flight,options,counters):
+    """
+      it tests the (url,lines,validators) items from a single process.
+      max_in_flight coroutines take URLs from the host-aware scheduler, so
+      up to max_in_flight requests are waiting on the network at any time
+      and each host gets no more than its limits (see host_limits).
+      the results go to results (a ResultWriter, or a StreamDedupe when
+      lines is the key of a streamed URL).
+      connections are kept alive for options["keepalive_timeout"] seconds
+      and reused; counters receives the run counters (see add_counters).
+    """
+    scheduler=HostScheduler(options,options["schedule_window"])
+    metrics=options["metrics"]
+    cache=worker_cache(options["cache_file"],options["print_lock"])
+    journal=None
+    if options["journal_file"] is not None:
+        journal=Journal(options["journal_file"]+"0000",options["journal_batch"])
+    timeout=aiohttp.ClientTimeout(total=None,sock_connect=options["connect_timeout"],
+                                  sock_read=options["read_timeout"])
+    install_dns_cache(options["dns_cache"])
+    # the threaded resolver goes through socket.getaddrinfo, so it uses
+    # the answers of the DNS pre-resolution stage.
+    connector=aiohttp.TCPConnector(limit=max_in_flight,resolver=aiohttp.ThreadedResolver(),
+                                   keepalive_timeout=options["keepalive_timeout"])
+    retry=options["retry"]
+    tally=[0,0,0,0,0,0,0]
+
+    async def connection_opened(session,context,params):
+        tally[0]+=1
+
+    async def request_made(session,context,params):
+        tally[1]+=1
+
+    trace=aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(connection_opened)
+    trace.on_request_start.append(request_made)
+
+    async def worker(session):
+        while True:
+            entry=await scheduler.get()
+            if entry is None:
+                return
+            hostname,(url,lines,validators)=entry
+            attempt=retry.attempt(url) if retry is not None else 1
+            if metrics is not None:
+                metrics.url_started(attempt > 1)
+            hold=SchedulerHold(scheduler,hostname)
+            try:
+                outcome=await check_url_async(session,url,options,validators,hold)
+            except Exception as e:
+                if metrics is not None:
+                    metrics.url_done("608")
+                test_failed(results,url,lines,e,options["print_lock"])
                 continue
-            if return_code == "608":
-                output_f.write("HTTP/1.1_@_608_@_Unknown Python exception_@__@_"+i_line+"\n")
+            finally:
+                await hold.release()
+            tally[3]+=outcome.size
+            if attempt == 1:
+                tally[2]+=1
+            else:
+                tally[5]+=1
+            if retry is not None and retry.defer((url,lines,validators),outcome):
+                if metrics is not None:
+                    metrics.url_deferred()
                 continue
-            continue
-        status = response.status_code
-        if status >  300 and status < 399:
-            headers=response.headers
-            redirection=headers["Location"]
-            continue
-        if status > 399:
-             output_f.write("HTTP/1.1_@_"+str(status)+"_@_"+"_@__@_"+i_line+"\n")
-             continue
-    except:
-        lock.acquire()
-        print "**ERROR "+str(i_line)
-        lock.release
-    output_f.close()
-    input_f.close()
+            if metrics is not None:
+                metrics.url_done(outcome.return_code)
+            if attempt > 1 and outcome.return_code is None:
+                tally[6]+=1
+            if outcome.note == "inferred":
+                tally[4]+=1
+            try:
+                if cache is not None:
+                    cache.put(url,outcome)
+                if journal is not None:
+                    journal.record(url,outcome)
+                results.result(lines,outcome.return_code,outcome.description,outcome.note,
+                               outcome.details())
+            except Exception as e:
+                test_failed(results,url,lines,e,options["print_lock"])
+
+    async with aiohttp.ClientSession(connector=connector,timeout=timeout,
+                                     trace_configs=[trace]) as session:
+        workers=[asyncio.ensure_future(worker(session)) for k in range(max_in_flight)]
+        dispatch_start=time.time()
+        await feed(scheduler,items)
+        await scheduler.close()
+        if metrics is not None:
+            metrics.add_phase("dispatch",time.time()-dispatch_start)
+        await asyncio.gather(*workers)
+        # the URLs with transient errors are tested again once they are due.
+        while retry is not None and len(retry.pending) > 0:
+            await asyncio.sleep(retry.wait())
+            due=retry.due()
+            scheduler=HostScheduler(options,options["schedule_window"])
+            workers=[asyncio.ensure_future(worker(session)) for k in range(min(max_in_flight,len(due)))]
+            for item in due:
+                await scheduler.put(item)
+            await scheduler.close()
+            await asyncio.gather(*workers)
+    if journal is not None:
+        journal.close()
+    if cache is not None:
+        cache.close()
+    if options["timeouts"] is not None and options["timeout_history"] is not None:
+        options["timeouts"].save(options["timeout_history"])
+    add_counters(counters,*tally)
     return
 
 
 
+def run_processes(items,temp_directory,process_count,batch_size,options,counters,results=None):
+    """
+      it spawns process_count process_file processes and feeds them
+      batches of batch_size (url,lines,validators) items through a shared
+      queue. the URLs of different hosts are interleaved (see
+      interleave_hosts). it waits until all processes finish and returns
+      the number of result_NNNN files.
+      in streaming mode, results (a StreamDedupe) receives the results of
+      the processes while items are still being read, and there are no
+      result_NNNN files.
+    """
+    # delete old result_ and metrics_ work files.
+    for k in range(process_count):
+         id='{:04d}'.format(k)
+         for file_path in (temp_directory+"result_"+id,temp_directory+"metrics_"+id):
+            try:
+               os.unlink(file_path)
+            except:
+               pass
+    # a few batches per process are enough to keep every process busy.
+    work_queue=Queue(maxsize=4*process_count)
+    result_queue=None
+    if results is not None:
+        result_queue=Queue()
+    host_slots=HostSlots()
+    procs = []
+    for number in range(process_count):
+        proc = Process(target=process_file, args=(number,work_queue,temp_directory,"result_",host_slots,options,counters,result_queue,))
+        procs.append(proc)
+        proc.start()
+
+    def collect():
+        # pass on the results received so far.
+        while True:
+            try:
+                message=result_queue.get_nowait()
+            except Empty:
+                return
+            results.result(*message)
+
+    metrics=options["metrics"]
+    dispatch_start=time.time()
+    batch=[]
+    if result_queue is not None:
+        # the input may wait on stdin: what is held goes out meanwhile.
+        items=idle_marks(items)
+    try:
+        for item in interleave_hosts(items,options["schedule_window"]):
+            if item is None:
+                if len(batch) > 0:
+                    work_queue.put(batch)
+                    batch=[]
+                collect()
+                continue
+            if len(batch) >= batch_size:
+                work_queue.put(batch)
+                batch=[]
+                if result_queue is not None:
+                    collect()
+            batch.append(item)
+        if len(batch) > 0:
+            work_queue.put(batch)
+    finally:
+        # the processes stop even when items raises.
+        for number in range(process_count):
+            work_queue.put(None)
+    if metrics is not None:
+        metrics.add_phase("dispatch",time.time()-dispatch_start)
+    if result_queue is not None:
+        # every process sends None when it is done.
+        finished=0
+        while finished < process_count:
+            try:
+                message=result_queue.get(timeout=5)
+            except Empty:
+                if not any(proc.is_alive() for proc in procs):
+                    break
+                continue
+            if message is None:
+                finished+=1
+            else:
+                results.result(*message)
+    # wait until all processes finish.
+    for proc in procs:
+         proc.join()
+    if metrics is not None:
+        for k in range(process_count):
+            metrics.load_hosts(temp_directory+"metrics_"+'{:04d}'.format(k))
+    if result_queue is not None:
+        return 0
+    return process_count
+
+
 if __name__ == '__main__':
     #  it expects a configuration file in the command line.
 
     os.environ["LANG"]="en_US.utf8"
     if len(sys.argv) < 2:
-      sys.stderr.write("usage:" +sys.argv [0]+" config_file"+"\n")
+      sys.stderr.write("usage:" +sys.argv [0]+" config_file [--resume] [--shard i/n | --merge n]"+"\n")
+      sys.stderr.write("    --resume: test only the URLs missing from the journal of an interrupted run."+"\n")
+      sys.stderr.write("    --shard i/n: test the hosts of shard i (0..n-1) and keep the results in shard_directory."+"\n")
+      sys.stderr.write("    --merge n: mail the reports of the n shards of shard_directory."+"\n")
       sys.stderr.write("configuration file entries:"+"\n")
       sys.stderr.write("    process_count= number of concurrent HTTP requests."+"\n")
       sys.stderr.write("    in_file= file that holds the URLs."+"\n")
       sys.stderr.write("    timer= HTTP timeout in seconds."+"\n")
+      sys.stderr.write("    connect_timeout= connection timeout in seconds (default timer)."+"\n")
+      sys.stderr.write("    read_timeout= timeout of the answer in seconds (default timer)."+"\n")
+      sys.stderr.write("    adaptive_timeouts= yes to adapt the timeouts to each host (default no)."+"\n")
+      sys.stderr.write("    timeout_min= lowest adaptive timeout in seconds (default 1)."+"\n")
+      sys.stderr.write("    timeout_max= highest adaptive read timeout in seconds (default 30)."+"\n")
+      sys.stderr.write("    timeout_history= yes to start from the answer times of the previous runs."+"\n")
       sys.stderr.write("    temp_directory=directory for work files."+"\n")
       sys.stderr.write("    exclude= file with (partial) URLs to ignore."+"\n")
       sys.stderr.write("    mailing_list= who will receive reports."+"\n")
       sys.stderr.write("    smtp_server= outbound mail server."+"\n")
       sys.stderr.write("    from_mail= email sender."+"\n")
+      sys.stderr.write("    batch_size= lines that a process takes at a time."+"\n")
+      sys.stderr.write("    engine= multiprocess (default) or async."+"\n")
+      sys.stderr.write("    max_in_flight= concurrent requests of the async engine."+"\n")
+      sys.stderr.write("    probe= get (default) or head (HEAD first, then a streamed GET)."+"\n")
+      sys.stderr.write("    head_bad_hosts= hosts that mishandle HEAD, separated by \",\"."+"\n")
+      sys.stderr.write("    host_max_in_flight= concurrent requests per host."+"\n")
+      sys.stderr.write("    host_rate= requests per second per host (0: no limit)."+"\n")
+      sys.stderr.write("    host_limit= domain|max_in_flight|rate for one domain (repeatable)."+"\n")
+      sys.stderr.write("    schedule_window= URLs grouped by host to interleave the hosts."+"\n")
+      sys.stderr.write("    cache_ttl= hours a healthy result is trusted (0: no cache)."+"\n")
+      sys.stderr.write("    cache_file= result cache (default temp_directory/url_cache.sqlite)."+"\n")
+      sys.stderr.write("    dns_workers= concurrent DNS lookups (0: no pre-resolution)."+"\n")
+      sys.stderr.write("    breaker_threshold= consecutive host failures that open the breaker (0: off)."+"\n")
+      sys.stderr.write("    breaker_cooldown= seconds before an open breaker sends probes."+"\n")
+      sys.stderr.write("    breaker_probes= probe requests of a half-open breaker."+"\n")
+      sys.stderr.write("    pool_connections= hosts with kept-alive connections."+"\n")
+      sys.stderr.write("    pool_maxsize= kept-alive connections per host."+"\n")
+      sys.stderr.write("    keepalive_timeout= idle seconds of a kept-alive connection (async)."+"\n")
+      sys.stderr.write("    streaming= yes to test the URLs while stdin is read (default no)."+"\n")
+      sys.stderr.write("    input_format= text (default) or alma_csv."+"\n")
+      sys.stderr.write("    csv_delimiter= field delimiter of alma_csv (default \",\")."+"\n")
+      sys.stderr.write("    resource_type= ALMA resource type|number (repeatable)."+"\n")
+      sys.stderr.write("    mail_digest= yes for one message per recipient group (default no)."+"\n")
+      sys.stderr.write("    smtp_timeout= seconds to wait for the smtp server (default 30)."+"\n")
+      sys.stderr.write("    purl_hosts= PURL servers resolved before the tests, separated by \",\"."+"\n")
+      sys.stderr.write("    purl_workers= concurrent PURL requests (0: PURLs are tested as is)."+"\n")
+      sys.stderr.write("    purl_ttl= hours a PURL target is kept in cache_file (0: only for the run)."+"\n")
+      sys.stderr.write("    max_redirects= redirects followed to test a URL (0: not followed)."+"\n")
+      sys.stderr.write("    progress_interval= seconds between progress lines (0: none)."+"\n")
+      sys.stderr.write("    metrics_file= Prometheus textfile written with the progress lines."+"\n")
+      sys.stderr.write("    metrics_hosts= hosts with most requests in metrics_file (default 50)."+"\n")
+      sys.stderr.write("    summary_file= JSON run summary (default temp_directory/run_summary.json)."+"\n")
+      sys.stderr.write("    journal_batch= results per journal write and fsync (0: no journal)."+"\n")
+      sys.stderr.write("    shard_directory= directory shared by the shards (default temp_directory)."+"\n")
+      sys.stderr.write("    retry_attempts= tests again of a URL with a transient error (0: none)."+"\n")
+      sys.stderr.write("    retry_delay= seconds before the first test again, doubled after each one."+"\n")
+      sys.stderr.write("    retry_budget= URLs tested again in the run (default 1000)."+"\n")
+      sys.stderr.write("    results_file= result records of the run (default temp_directory/results.jsonl)."+"\n")
+      sys.stderr.write("    report_mode= full (default) or diff (changes since the last run)."+"\n")
+      sys.stderr.write("    large_input= yes to dedupe the URLs in partitions on disk (default no)."+"\n")
+      sys.stderr.write("    partition_lines= input lines per partition of large_input (default 200000)."+"\n")
       exit(1)
 
     try:
@@ -286,12 +3302,60 @@ if __name__ == '__main__':
 
     process_count=int(6)   #  default value for concurrent requests is 6.
     timer=int(10)     # default timeout value is 10 seconds.
+    connect_timeout=None    # default: timer.
+    read_timeout=None       # default: timer.
+    adaptive_timeouts="no"  # "yes": timeouts from the answer times of each host.
+    timeout_min=float(1)    # lowest adaptive timeout.
+    timeout_max=float(30)   # highest adaptive read timeout.
+    timeout_history="no"    # "yes": answer times of the previous runs (cache_file).
     in_file=""
     temp_directory=""
     exclude=""
     mailing_list=""
     smtp_server=""
     from_mail=""
+    batch_size=int(20)      # lines that a process takes from the work queue at a time.
+    engine="multiprocess"   # "multiprocess" or "async".
+    max_in_flight=int(500)  # concurrent requests of the async engine.
+    probe_method="get"      # "get" or "head" (HEAD first, then a streamed GET).
+    head_bad_hosts=[]       # hosts that mishandle HEAD requests.
+    host_max_in_flight=int(4)  # concurrent requests per host.
+    host_rate=float(0)      # requests per second per host (0: no limit).
+    host_limit_list=[]      # (domain,max_in_flight,rate) overrides.
+    schedule_window=int(10000)  # URLs grouped by host by the scheduler.
+    cache_ttl=float(0)      # hours a healthy result is trusted (0: no cache).
+    cache_file=""           # default: temp_directory/url_cache.sqlite
+    dns_workers=int(32)     # concurrent DNS lookups (0: no pre-resolution).
+    breaker_threshold=int(0)  # consecutive host failures that open the breaker (0: off).
+    breaker_cooldown=float(120)  # seconds before an open breaker lets probes through.
+    breaker_probes=int(2)   # probe requests of a half-open breaker.
+    param_missing=0
+    pool_connections=int(500)  # hosts with a pool of kept-alive connections.
+    pool_maxsize=int(4)     # kept-alive connections per host.
+    keepalive_timeout=float(30)  # idle seconds before a pooled connection is closed.
+    streaming="no"          # "yes": test the URLs while stdin is read.
+    input_format="text"     # "text" or "alma_csv".
+    csv_delimiter=","       # field delimiter of the ALMA CSV file.
+    resource_types={}       # ALMA resource type -> resource_type.
+    mail_digest="no"        # "yes": one message per recipient group.
+    smtp_timeout=float(30)  # seconds to wait for the smtp server.
+    purl_hosts=["pid.emory.edu"]  # PURL servers resolved before the tests.
+    purl_workers=int(4)     # concurrent PURL requests (0: no resolution).
+    purl_ttl=float(0)       # hours a PURL target is kept (0: only for the run).
+    max_redirects=int(0)    # redirects followed to test a URL (0: not followed).
+    progress_interval=float(60)  # seconds between progress lines (0: none).
+    metrics_file=""         # Prometheus textfile (default: none).
+    metrics_hosts=int(50)   # hosts with the most requests in metrics_file.
+    summary_file=""         # default: temp_directory/run_summary.json
+    journal_batch=int(200)  # results per journal write and fsync (0: no journal).
+    shard_directory=""      # default: temp_directory.
+    retry_attempts=int(0)   # tests again of a URL with a transient error (0: none).
+    retry_delay=float(30)   # seconds before the first test again.
+    retry_budget=int(1000)  # URLs tested again in the run.
+    results_file=""         # default: temp_directory/results.jsonl
+    report_mode="full"      # "full" or "diff" (changes since the last run).
+    large_input="no"        # "yes": the URLs are deduped in partitions on disk.
+    partition_lines=int(200000)  # input lines per partition of large_input.
 
     param=re.compile("(.*?)=(.*)")
     for line in config:
@@ -303,6 +3367,18 @@ if __name__ == '__main__':
             process_count=int(process_count)
          if m.group(1) == "timer":
             timer=str(m.group(2))
+         if m.group(1) == "connect_timeout":
+            connect_timeout=float(m.group(2))
+         if m.group(1) == "read_timeout":
+            read_timeout=float(m.group(2))
+         if m.group(1) == "adaptive_timeouts":
+            adaptive_timeouts=str(m.group(2)).lower()
+         if m.group(1) == "timeout_min":
+            timeout_min=float(m.group(2))
+         if m.group(1) == "timeout_max":
+            timeout_max=float(m.group(2))
+         if m.group(1) == "timeout_history":
+            timeout_history=str(m.group(2)).lower()
          if m.group(1) == "in_file":
             in_file=str(m.group(2))
          if m.group(1) == "temp_directory":
@@ -315,16 +3391,129 @@ if __name__ == '__main__':
             smtp_server=str(m.group(2))
          if m.group(1) == "from_mail":
             from_mail=str(m.group(2))
+         if m.group(1) == "engine":
+            engine=str(m.group(2))
+         if m.group(1) == "max_in_flight":
+            max_in_flight=int(m.group(2))
+         if m.group(1) == "batch_size":
+            batch_size=int(m.group(2))
+         if m.group(1) == "probe":
+            probe_method=str(m.group(2))
+         if m.group(1) == "head_bad_hosts":
+            head_bad_hosts=[host.strip().lower() for host in m.group(2).split(",") if host.strip() != ""]
+         if m.group(1) == "host_max_in_flight":
+            host_max_in_flight=int(m.group(2))
+         if m.group(1) == "host_rate":
+            host_rate=float(m.group(2))
+         if m.group(1) == "host_limit":
+            try:
+               domain,limit,rate=m.group(2).split("|")
+               host_limit_list.append((domain.strip().lower(),int(limit),float(rate)))
+            except ValueError:
+               sys.stderr.write("invalid host_limit: "+m.group(2)+"\n")
+               param_missing+=1
+         if m.group(1) == "schedule_window":
+            schedule_window=int(m.group(2))
+         if m.group(1) == "cache_ttl":
+            cache_ttl=float(m.group(2))
+         if m.group(1) == "cache_file":
+            cache_file=str(m.group(2))
+         if m.group(1) == "dns_workers":
+            dns_workers=int(m.group(2))
+         if m.group(1) == "breaker_threshold":
+            breaker_threshold=int(m.group(2))
+         if m.group(1) == "breaker_cooldown":
+            breaker_cooldown=float(m.group(2))
+         if m.group(1) == "breaker_probes":
+            breaker_probes=int(m.group(2))
+         if m.group(1) == "pool_connections":
+            pool_connections=int(m.group(2))
+         if m.group(1) == "pool_maxsize":
+            pool_maxsize=int(m.group(2))
+         if m.group(1) == "keepalive_timeout":
+            keepalive_timeout=float(m.group(2))
+         if m.group(1) == "streaming":
+            streaming=str(m.group(2)).lower()
+         if m.group(1) == "input_format":
+            input_format=str(m.group(2))
+         if m.group(1) == "csv_delimiter":
+            csv_delimiter=str(m.group(2))
+         if m.group(1) == "mail_digest":
+            mail_digest=str(m.group(2)).lower()
+         if m.group(1) == "smtp_timeout":
+            smtp_timeout=float(m.group(2))
+         if m.group(1) == "purl_hosts":
+            purl_hosts=[host.strip().lower() for host in m.group(2).split(",") if host.strip() != ""]
+         if m.group(1) == "purl_workers":
+            purl_workers=int(m.group(2))
+         if m.group(1) == "purl_ttl":
+            purl_ttl=float(m.group(2))
+         if m.group(1) == "max_redirects":
+            max_redirects=int(m.group(2))
+         if m.group(1) == "progress_interval":
+            progress_interval=float(m.group(2))
+         if m.group(1) == "metrics_file":
+            metrics_file=str(m.group(2))
+         if m.group(1) == "metrics_hosts":
+            metrics_hosts=int(m.group(2))
+         if m.group(1) == "summary_file":
+            summary_file=str(m.group(2))
+         if m.group(1) == "journal_batch":
+            journal_batch=int(m.group(2))
+         if m.group(1) == "shard_directory":
+            shard_directory=str(m.group(2))
+         if m.group(1) == "retry_attempts":
+            retry_attempts=int(m.group(2))
+         if m.group(1) == "retry_delay":
+            retry_delay=float(m.group(2))
+         if m.group(1) == "retry_budget":
+            retry_budget=int(m.group(2))
+         if m.group(1) == "results_file":
+            results_file=str(m.group(2))
+         if m.group(1) == "report_mode":
+            report_mode=str(m.group(2))
+         if m.group(1) == "large_input":
+            large_input=str(m.group(2))
+         if m.group(1) == "partition_lines":
+            partition_lines=int(m.group(2))
+         if m.group(1) == "resource_type":
+            try:
+               r_name,r_type=m.group(2).split("|")
+               resource_types[r_name.strip()]=str(int(r_type))
+            except ValueError:
+               sys.stderr.write("invalid resource_type: "+m.group(2)+"\n")
+               param_missing+=1
 
     config.close()
-    param_missing=0
+    # command line options after the configuration file.
+    argument=sys.argv[2:]
+    resume="--resume" in argument
+    shard_index=0
+    shard_count=0     # 0: not sharded.
+    merge_count=0     # shards to merge (--merge n).
+    for k in range(len(argument)):
+       try:
+          if argument[k] == "--shard":
+             shard_index,shard_count=[int(value) for value in argument[k+1].split("/")]
+             if shard_count < 1 or shard_index < 0 or shard_index >= shard_count:
+                raise ValueError
+          if argument[k] == "--merge":
+             merge_count=int(argument[k+1])
+             if merge_count < 1:
+                raise ValueError
+       except (ValueError,IndexError):
+          sys.stderr.write("invalid "+argument[k]+" (--shard i/n with 0 <= i < n, --merge n)\n")
+          param_missing+=1
+    if shard_count > 0 and merge_count > 0:
+       sys.stderr.write("--shard and --merge are exclusive\n")
+       param_missing+=1
     if temp_directory == "":
        sys.stderr.write("work directory not specified\n")
        param_missing+=1
     if mailing_list == "":
        sys.stderr.write("mailing list not specified\n")
        param_missing+=1
-    if in_file == "":
+    if in_file == "" and streaming != "yes" and shard_count == 0 and merge_count == 0:
        sys.stderr.write("in_file  not specified\n")
        param_missing+=1
     if smtp_server == "":
@@ -334,11 +3523,83 @@ if __name__ == '__main__':
        sys.stderr.write("from_mail not specified\n")
        param_missing+=1
 
+    if engine != "multiprocess" and engine != "async":
+       sys.stderr.write("engine must be multiprocess or async\n")
+       param_missing+=1
+    if engine == "async" and aiohttp is None:
+       sys.stderr.write("engine=async requires the aiohttp module\n")
+       param_missing+=1
+    if probe_method != "get" and probe_method != "head":
+       sys.stderr.write("probe must be get or head\n")
+       param_missing+=1
+    if schedule_window < 1:
+       sys.stderr.write("schedule_window must be greater than zero\n")
+       param_missing+=1
+    if engine == "async" and max_in_flight < 1:
+       sys.stderr.write("max_in_flight must be greater than zero\n")
+       param_missing+=1
+    if streaming != "yes" and streaming != "no":
+       sys.stderr.write("streaming must be yes or no\n")
+       param_missing+=1
+    streaming=streaming == "yes"
+    if input_format != "text" and input_format != "alma_csv":
+       sys.stderr.write("input_format must be text or alma_csv\n")
+       param_missing+=1
+    if len(csv_delimiter) != 1:
+       sys.stderr.write("csv_delimiter must be one character\n")
+       param_missing+=1
+    if len(resource_types) == 0:
+       resource_types=alma_resource_types
+    if mail_digest != "yes" and mail_digest != "no":
+       sys.stderr.write("mail_digest must be yes or no\n")
+       param_missing+=1
+    mail_digest=mail_digest == "yes"
+    if connect_timeout is None:
+       connect_timeout=float(timer)
+    if read_timeout is None:
+       read_timeout=float(timer)
+    if adaptive_timeouts != "yes" and adaptive_timeouts != "no":
+       sys.stderr.write("adaptive_timeouts must be yes or no\n")
+       param_missing+=1
+    adaptive_timeouts=adaptive_timeouts == "yes"
+    if timeout_history != "yes" and timeout_history != "no":
+       sys.stderr.write("timeout_history must be yes or no\n")
+       param_missing+=1
+    timeout_history=timeout_history == "yes"
+    if timeout_min <= 0 or timeout_max < timeout_min:
+       sys.stderr.write("timeout_min must be greater than zero and not above timeout_max\n")
+       param_missing+=1
+    if report_mode != "full" and report_mode != "diff":
+       sys.stderr.write("report_mode must be full or diff\n")
+       param_missing+=1
+    if large_input != "yes" and large_input != "no":
+       sys.stderr.write("large_input must be yes or no\n")
+       param_missing+=1
+    large_input=large_input == "yes"
+    if large_input and streaming:
+       sys.stderr.write("large_input requires streaming=no\n")
+       param_missing+=1
+    if partition_lines < 1:
+       sys.stderr.write("partition_lines must be greater than zero\n")
+       param_missing+=1
+
     if param_missing > 0:
        exit(1)
+    if shard_directory == "":
+       shard_directory=temp_directory
+    if results_file == "":
+       results_file=temp_directory+"results.jsonl"
+    if shard_count > 0:
+       # each shard has its own work files, so the shards may share a
+       # machine and temp_directory.
+       temp_directory=os.path.join(temp_directory,"shard_"+str(shard_index))+"/"
+       in_file=temp_directory+"url_list.txt"
+       try:
+          os.makedirs(temp_directory,exist_ok=True)
+       except OSError as e:
+          sys.stderr.write("**ERR: couldn't create "+temp_directory+": "+str(e)+"\n")
+          exit(1)
 
-    procs = []
-    exclusion=[]
     try:
         mail_f=open(mailing_list,'r')
     except:
@@ -346,36 +3607,81 @@ if __name__ == '__main__':
         exit(1)
     email_info={}
     # mailing list is indexed by the record type (bibliographic or portfolio).
-    # max_number will hold  the highest index.
     # typical mailing list entry:
         #digit|record or resource type|email addresses separated by ","
-    max_number=int(0)
 
     for line in mail_f:
         line=line.rstrip("\n")
         r_type,r_name,mail_address=line.split("|")
-        email_info[r_type]=str(r_name)+"|"+mail_address
-        if int(r_type) > max_number:
-            max_number=int(r_type)
+        email_info[str(int(r_type))]=str(r_name)+"|"+mail_address
     mail_f.close()
 
+    # the result records of the run are kept in results_file; in diff
+    # mode, the reports hold the changes since the records of the last run.
+    baseline=None
+    if report_mode == "diff" and shard_count == 0:
+       baseline=read_baseline(results_file)
+
+    if merge_count > 0:
+       # the shards are done: collate their results and mail the reports once.
+       # the shards don't record their input lines, so in diff mode every
+       # failure of the last run that is not failing now is fixed.
+       aggregator=ReportAggregator(temp_directory,archive=results_file,baseline=baseline)
+       missing=merge_shards(shard_directory,merge_count,aggregator)
+       if len(missing) > 0:
+          sys.stderr.write("**ERR: results missing for shards "+",".join(str(k) for k in missing)+
+                           " of "+str(merge_count)+" in "+shard_directory+"\n")
+          aggregator.close()
+          exit(1)
+       mailer=Mailer(smtp_server,smtp_timeout)
+       send_reports(mailer,aggregator,email_info,from_mail,mail_digest)
+       mailer.close()
+       if baseline is not None:
+          sys.stderr.write("failures unchanged since the last run: "+str(aggregator.unchanged)+
+                           " fixed: "+str(aggregator.fixed)+"\n")
+       if mailer.unsent == 0:
+          aggregator.commit()
+          for k in range(merge_count):
+             os.unlink(shard_file(shard_directory,k,merge_count))
+       aggregator.close()
+       if mailer.unsent > 0:
+          exit(1)
+       exit(0)
+
+    # the metrics of the run (see RunMetrics); the worker processes share
+    # print_lock to write to stderr.
+    metrics=RunMetrics()
+    print_lock=Lock()
+    counters=Array('l',[0,0,0,0,0,0,0])
+    reporter_stop=None
+    if progress_interval > 0:
+       reporter_stop=metrics.start_reporter(progress_interval,metrics_file,counters,metrics_hosts,print_lock)
+    metrics.phase("ingest")
+
     # get number of text lines in input file.
     line_count=0
-    try:
+    if streaming:
+       # the lines go from stdin to the checks (see StreamDedupe).
+       first_line=sys.stdin.readline()
+       if first_line != "":
+          line_count=1
+       input_f=itertools.chain([first_line],sys.stdin)
+    else:
+     try:
        input_f=open(in_file,'w')
-    except:
+     except:
        sys.stderr.write("**ERR: couldn't create input file"+"\n")
        exit(1)
 
-    try:
+     try:
        for line in sys.stdin:
           line_count+=1
           input_f.write(line)         
-    except:
+     except:
          pass
-    input_f.close()
+     input_f.close()
 
-    #print "line_count:"+str(line_count)
+    #print("line_count:"+str(line_count))
 
     if line_count == 0:
        sys.stderr.write("**ERR: input file is empty"+"\n")
@@ -384,89 +3690,10 @@ if __name__ == '__main__':
     if process_count == 0:
        sys.stderr.write("**ERR: process count must not be zero"+"\n")
        exit(1)
-
-    chunk_size=line_count/process_count
-    extra_lines=line_count%process_count # (modulo tells us if we need
-                            #  an extra process.
-
-   ####  take care of trivial case 
-    if chunk_size == 0:
-       chunk_size=extra_lines
-       process_count=0
-   ###  trivial case 
-
-    total_processes=process_count
-    if extra_lines > 0:
-      total_processes=process_count+1
-      process_count=total_processes
-
-    total_processes=int(total_processes)  # make sure that is an integer.
-    next_chunk=0
-    file_path=temp_directory+"/"+"batch_*"
-    batch='{:04d}'.format(next_chunk)
-    batch=temp_directory+"/batch_"+batch
-    batch=batch.replace("//","/")
-       # delete work files ( batch_ and result_ )
-    for k in range(total_processes):
-         id='{:04d}'.format(k)
-         file_path=temp_directory+"batch_"+id
-         try:
-            os.unlink(file_path)
-         except:
-            pass
-
-    for k in range(total_processes):
-         id='{:04d}'.format(k)
-         file_path=temp_directory+"result_"+id
-         try:
-            os.unlink(file_path)
-         except:
-            pass
-    try:
-        output_f=open(batch,'w')
-    except:
-       sys.stderr.write("**ERR: couldn't open output "+str(batch)+"\n")
+    if batch_size < 1:
+       sys.stderr.write("**ERR: batch_size must be greater than zero"+"\n")
        exit(1)
 
-    # divide input file into chunks that are passed to concurrent
-    # processes.
-    line_count=0
-    try:
-       input_f=open(in_file,'r')
-    except:
-       sys.stderr.write("**ERR: couldn't open input file"+"\n")
-       exit(1)
-    for line in input_f:
-        if line_count == chunk_size:
-           next_chunk+=1
-           output_f.close()
-           if next_chunk == total_processes:
-               break
-           batch='{:04d}'.format(next_chunk)
-           batch=temp_directory+"/batch_"+batch
-           batch=batch.replace("//","/")
-           try:
-              output_f=open(batch,'w')
-           except:
-              sys.stderr.write("**ERR: couldn't open output "+str(batch)+"\n")
-              exit(1)
-           output_f.write(line)
-           line_count=1
-        else:
-           line_count+=1
-           output_f.write(line)
-    input_f.close()
-    if extra_lines > 0 and total_processes > 1:
-           batch='{:04d}'.format(next_chunk)
-           batch=temp_directory+"/batch_"+batch
-           batch=batch.replace("//","/")
-           try:
-              output_f=open(batch,'w')
-           except:
-              sys.stderr.write("**ERR: couldn't open output "+str(batch)+"\n")
-              exit(1)
-           output_f.write(line)
-    output_f.close()
     exclusion=[]
     exclude_OK=True
     # create a list of exclusion strings (partial or total URL).
@@ -480,67 +3707,219 @@ if __name__ == '__main__':
         for line in exclude_f:
             line=line.rstrip("\n")
             exclusion.append(line)
+    exclusion=ExcludeMatcher(exclusion)
 
-    # spawn concurrent processes. each process handles a batch
-    # of URLs.
+    # request settings and the run counters (see add_counters).
+    options={"pool_connections":pool_connections,"pool_maxsize":pool_maxsize,
+             "keepalive_timeout":keepalive_timeout,"probe":probe_method,
+             "head_bad_hosts":head_bad_hosts,"host_max_in_flight":host_max_in_flight,
+             "host_rate":host_rate,"host_limits":host_limit_list,
+             "schedule_window":schedule_window,"cache_file":None,"dns_cache":{},
+             "breaker":None,"max_redirects":max_redirects,"redirect_cache":{},
+             "metrics":metrics,"print_lock":print_lock,"journal_file":None,
+             "journal_batch":journal_batch,"connect_timeout":connect_timeout,
+             "read_timeout":read_timeout,"timeouts":None,"timeout_history":None,
+             "retry":None}
+    if retry_attempts > 0:
+       options["retry"]=RetryQueue(retry_attempts,retry_delay,retry_budget)
+    if breaker_threshold > 0:
+       options["breaker"]=HostBreaker(breaker_threshold,breaker_cooldown,breaker_probes)
+    if max_redirects > 0 and engine == "multiprocess":
+       # the redirect hops are shared by the worker processes.
+       manager=Manager()
+       options["redirect_cache"]=manager.dict()
 
-    for number in range(total_processes):
-        proc = Process(target=process_file, args=(number,temp_directory,"batch_","result_",timer,exclusion,))
-        procs.append(proc)
-        proc.start()
-    # wait until all processes finish.
-    for proc in procs:
-         proc.join()
-    dirs = os.listdir( temp_directory )
-    
-  ## prepare lists according to the result types from HTTP GETs.
-
-    url_result=re.compile("result_(.*)")
-    unknown_hostname=[]
-    connection_timedout=[]
-    unsupported_HTTP_protocol=[]
-    unknown_exception=[]
-    ill_formed_url=[]
-    connection_failed=[]
-    bad_request=[]
-    pass_required=[]
-    forbidden=[]
-    not_found=[]
-    internal_error=[]
-
-    for i in range(int(max_number)+1):
-        connection_timedout.append("")
-    for i in range(int(max_number)+1):
-        unknown_hostname.append("")
-    for i in range(int(max_number)+1):
-        unsupported_HTTP_protocol.append("")
-    for i in range(int(max_number)+1):
-        unknown_exception.append("")
-    for i in range(int(max_number)+1):
-        ill_formed_url.append("")
-    for i in range(int(max_number)+1):
-        connection_failed.append("")
-    for i in range(int(max_number)+1):
-        bad_request.append("")
-    for i in range(int(max_number)+1):
-        pass_required.append("")
-    for i in range(int(max_number)+1):
-        pass_required.append("")
-    for i in range(int(max_number)+1):
-        forbidden.append("")
-    for i in range(int(max_number)+1):
-        not_found.append("")
-    for i in range(int(max_number)+1):
-        internal_error.append("")
-
-#  _@_603_@_unknown hostname_@__@_"+line+"\n")
-#  _@_605_@_connection timed out_@__@_"+line+"\n")
-#  _@_607_@_unsupported HTTP protocol_@__@_"+line+"\n")
-#  _@_608_@_Unknown Python exception_@__@_"+line+"\n")
-#  _@_609_@_Ill-formed URL_@__@_"+line+"\n")
-#  _@_610_@_Connection to server failed_
-  
+    # the workers journal their results; --resume takes the results of
+    # the journal instead of testing the URLs again.
+    journaled=None
+    if resume:
+       journaled=read_journal(temp_directory)
+    else:
+       for file_path in journal_files(temp_directory):
+          os.unlink(file_path)
+    if journal_batch > 0:
+       options["journal_file"]=temp_directory+"journal_"
+    # each distinct URL is tested once for all the mms_ids that reference it.
+    if cache_file == "":
+       cache_file=temp_directory+"url_cache.sqlite"
+    # the timeouts adapt to the answer times of each host.
+    if adaptive_timeouts:
+       history=None
+       if timeout_history:
+          try:
+             history_cache=ResultCache(cache_file)
+             history=history_cache.latencies()
+             history_cache.close()
+          except sqlite3.Error as e:
+             sys.stderr.write("**ERR: couldn't use cache "+cache_file+": "+str(e)+"\n")
+             exit(1)
+          options["timeout_history"]=cache_file
+       options["timeouts"]=HostTimeouts(connect_timeout,read_timeout,timeout_min,timeout_max,history)
+    # PURLs are replaced by their targets before dedupe.
+    purl_resolver=None
+    if purl_workers > 0 and len(purl_hosts) > 0:
+       purl_cache=None
+       if purl_ttl > 0:
+          try:
+             purl_cache=ResultCache(cache_file)
+          except sqlite3.Error as e:
+             sys.stderr.write("**ERR: couldn't use cache "+cache_file+": "+str(e)+"\n")
+             exit(1)
+       purl_resolver=PurlResolver(purl_hosts,timer,purl_workers,purl_cache,purl_ttl*3600)
+    # the failed URLs by report and resource type; a shard keeps its
+    # result records for the merge instead.
+    if shard_count > 0:
+       shard_path=shard_file(shard_directory,shard_index,shard_count)
+       try:
+          # the results of an earlier run must not be merged.
+          if os.path.exists(shard_path):
+             os.unlink(shard_path)
+          results_out=RecordFile(open(shard_path+".tmp",'w'))
+       except OSError as e:
+          sys.stderr.write("**ERR: couldn't create "+shard_path+": "+str(e)+"\n")
+          exit(1)
+    else:
+       try:
+          aggregator=ReportAggregator(temp_directory,archive=results_file,baseline=baseline)
+       except OSError as e:
+          sys.stderr.write("**ERR: couldn't create "+results_file+": "+str(e)+"\n")
+          exit(1)
+       results_out=aggregator
+    if streaming:
+       # the results go to the aggregator instead of result_NNNN.
+       dedupe=StreamDedupe(ResultWriter(results_out))
+    else:
+       try:
+          input_f=open(in_file,'r')
+       except:
+          sys.stderr.write("**ERR: couldn't open input file"+"\n")
+          exit(1)
+       url_input=input_f
+       if input_format == "alma_csv":
+          # in large-input mode the repeated rows are dropped by
+          # PartitionDedupe, one partition at a time.
+          url_input=alma_csv_lines(input_f,csv_delimiter,resource_types,not large_input)
+       url_input=select_lines(url_input,exclusion)
+       if shard_count > 0:
+          url_input=shard_lines(url_input,shard_index,shard_count,
+                                purl_hosts if purl_resolver is not None else ())
+       else:
+          url_input=aggregator.lines(url_input)
+       if purl_resolver is not None:
+          url_input=purl_resolver.items(url_input)
+       if large_input:
+          # the lines are deduped one partition at a time, while the URLs
+          # are tested (see PartitionDedupe).
+          partitions=(line_count+partition_lines-1)//partition_lines
+          dedupe=PartitionDedupe(ResultWriter(results_out),temp_directory,partitions,
+                                 input_format == "alma_csv")
+          dedupe.partition(url_input)
+          input_f.close()
+          sys.stderr.write("lines partitioned: "+str(dedupe.line_count)+" in "+str(partitions)+
+                           " partitions\n")
+       else:
+          items,url_lines=dedupe_urls(url_input)
+          distinct_urls=len(items)
+          input_f.close()
+          if len(items) > 0:
+             sys.stderr.write("URL lines: "+str(url_lines)+" distinct URLs: "+str(len(items))+
+                              " (dedupe ratio "+'{:.2f}'.format(float(url_lines)/len(items))+")\n")
+          if journaled is not None:
+             items,resumed=apply_journal(items,journaled,ResultWriter(results_out))
+             sys.stderr.write("URLs resumed from the journal: "+str(resumed)+"\n")
+    # URLs that were healthy within cache_ttl hours are not tested again.
+    cache=None
+    if cache_ttl > 0:
+       try:
+          cache=ResultCache(cache_file)
+          if not streaming and not large_input:
+             items,skipped=apply_cache(items,cache,cache_ttl*3600)
+             cache.close()
+       except sqlite3.Error as e:
+          sys.stderr.write("**ERR: couldn't use cache "+cache_file+": "+str(e)+"\n")
+          exit(1)
+       options["cache_file"]=cache_file
+       if not streaming and not large_input:
+          sys.stderr.write("healthy URLs skipped (cache): "+str(skipped)+"\n")
+    if streaming:
+       url_input=input_f
+       if input_format == "alma_csv":
+          url_input=alma_csv_lines(input_f,csv_delimiter,resource_types)
+       url_input=select_lines(url_input,exclusion)
+       if shard_count > 0:
+          url_input=shard_lines(url_input,shard_index,shard_count,
+                                purl_hosts if purl_resolver is not None else ())
+       else:
+          url_input=aggregator.lines(url_input)
+       if purl_resolver is not None:
+          url_input=purl_resolver.items(url_input)
+       items=dedupe.items(url_input,cache,cache_ttl*3600,journaled)
+    elif large_input:
+       items=dedupe.items(cache,cache_ttl*3600,journaled)
+    # resolve every hostname once; URLs on unknown hosts get 603 without
+    # a request.
+    if not streaming and dns_workers > 0:
+       if large_input:
+          answers=resolve_hostnames(dedupe.hostnames,dns_workers)
+       else:
+          answers=resolve_hosts(items,dns_workers)
+       options["dns_cache"]=answers
+       unknown=[hostname for hostname in answers if answers[hostname] is None]
+       sys.stderr.write("hostnames resolved: "+str(len(answers))+" unknown: "+str(len(unknown))+"\n")
+    if not streaming and not large_input:
+       metrics.url_total=len(items)
+    metrics.phase("check")
+    if engine == "async":
+       # a single process keeps up to max_in_flight requests in flight.
+       total_processes=1
+       if streaming:
+          asyncio.run(process_file_async(items,dedupe,max_in_flight,options,counters))
+       else:
+          result_file=temp_directory+"result_0000"
+          try:
+             output_f=open(result_file,'w')
+          except:
+             sys.stderr.write("**ERR: couldn't open work files"+"\n")
+             exit(1)
+          asyncio.run(process_file_async(items,ResultWriter(RecordFile(output_f)),max_in_flight,options,counters))
+          output_f.close()
+    elif streaming:
+       total_processes=run_processes(items,temp_directory,process_count,batch_size,options,counters,dedupe)
+    else:
+       total_processes=run_processes(items,temp_directory,process_count,batch_size,options,counters)
+    if streaming or large_input:
+       if cache is not None:
+          cache.close()
+       if dedupe.url_count > 0:
+          sys.stderr.write("URL lines: "+str(dedupe.line_count)+" distinct URLs: "+str(dedupe.url_count)+
+                           " (dedupe ratio "+'{:.2f}'.format(float(dedupe.line_count)/dedupe.url_count)+")\n")
+       if cache is not None:
+          sys.stderr.write("healthy URLs skipped (cache): "+str(dedupe.skipped)+"\n")
+       if journaled is not None:
+          sys.stderr.write("URLs resumed from the journal: "+str(dedupe.resumed)+"\n")
+    if streaming:
+       total_processes=0
+    if purl_resolver is not None:
+       if purl_resolver.cache is not None:
+          purl_resolver.cache.close()
+       sys.stderr.write("PURLs resolved: "+str(purl_resolver.resolved)+
+                        " memo hits: "+str(purl_resolver.memo_hits)+"\n")
+    if counters[1] > 0:
+       sys.stderr.write("connections opened: "+str(counters[0])+" requests made: "+str(counters[1])+
+                        " ("+'{:.1f}'.format(float(counters[1])/max(counters[0],1))+" requests per connection)\n")
+    if counters[2] > 0:
+       sys.stderr.write("URLs tested: "+str(counters[2])+" bytes transferred: "+str(counters[3])+
+                        " ("+str(counters[3]//counters[2])+" bytes per URL)\n")
+    if counters[4] > 0:
+       sys.stderr.write("URLs inferred by the circuit breaker: "+str(counters[4])+"\n")
+    if counters[5] > 0:
+       sys.stderr.write("URLs tested again: "+str(counters[5])+" healthy: "+str(counters[6])+"\n")
+    # every URL is tested: the journal only protects the checks, so the
+    # next run (even one whose reports fail) starts from the first URL.
+    for file_path in journal_files(temp_directory):
+       os.unlink(file_path)
 # read each result file and collate according to result type.
+    metrics.phase("collate")
     for k in range(total_processes):
         id='{:04d}'.format(k)
         file_path=temp_directory+"/result_"+id
@@ -550,139 +3929,46 @@ if __name__ == '__main__':
              sys.stderr.write("**ERR: couldn't open input "+str(file_path)+"\n")
              continue
         for line in result_f:
-            try:
-                 line=line.rstrip("\n")
-                 field=line.split("_@_")
-                 return_code=int(field[1])
-                 url_info=field[4]
-                 target,mms_id,resource_type=url_info.split("_|_")
-                 if return_code == 603:
-                     report_URL(mms_id,resource_type,target,unknown_hostname)  
-                 elif return_code == 605:
-                     report_URL(mms_id,resource_type,target,connection_timedout)  
-                 elif return_code == 607:
-                     report_URL(mms_id,resource_type,target,unsupported_HTTP_protocol)  
-                 elif return_code == 608:
-                     report_URL(mms_id,resource_type,target,unknown_exception)  
-                 elif return_code == 609:
-                     report_URL(mms_id,resource_type,target,ill_formed_url)  
-                 elif return_code == 610:
-                     report_URL(mms_id,resource_type,target,connection_failed)  
-                 elif return_code == 400:
-                     report_URL(mms_id,resource_type,target,bad_request)  
-                 elif return_code == 401:
-                     report_URL(mms_id,resource_type,target,pass_required)  
-                 elif return_code == 403:
-                     report_URL(mms_id,resource_type,target,forbidden)  
-                 elif return_code == 404 or return_code == 410:
-                     report_URL(mms_id,resource_type,target,not_found)  
-                 elif return_code == 500:
-                     report_URL(mms_id,resource_type,target,internal_error)  
-                 elif return_code == 501:
-                     report_URL(mms_id,resource_type,target,unsupported_HTTP_protocol)  
-
-            except:
-              sys.stderr.write("**ERR: failed to process HTTP results"+"\n")
-              continue
+            results_out.write(line)
         result_f.close()
     #
-  # send emails  with results.
-
-    if len(not_found) > 0:
-          for entry in not_found:
-              rtype_id=not_found.index(entry)
-              try:
-                    rname,recipients=email_info[str(rtype_id)].split("|")
-              except:
-                    continue
-              subject="[urlchecker "+rname+"] URL not found (nicht gefunden)"
-              send_email(smtp_server,recipients,from_mail,entry,subject)
-    if len(unknown_hostname) > 0:
-          for entry in unknown_hostname:
-              rtype_id=unknown_hostname.index(entry)
-              try:
-                    rname,recipients=email_info[str(rtype_id)].split("|")
-              except:
-                    continue
-              subject="[urlchecker "+rname+"] unknown hostname (unbekannter gastgeber)"
-              send_email(smtp_server,recipients,from_mail,entry,subject)
-    if len(unsupported_HTTP_protocol) > 0:
-          for entry in unsupported_HTTP_protocol:
-              rtype_id=unsupported_HTTP_protocol.index(entry)
-              try:
-                    rname,recipients=email_info[str(rtype_id)].split("|")
-              except:
-                    continue
-              subject="[urlchecker "+rname+"] unsupported HTTP protocol (nicht unterstütztes Protokoll)"
-              send_email(smtp_server,recipients,from_mail,entry,subject)
-    if len(ill_formed_url) > 0:
-          for entry in ill_formed_url:
-              rtype_id=ill_formed_url.index(entry)
-              try:
-                    rname,recipients=email_info[str(rtype_id)].split("|")
-              except:
-                    continue
-              subject="[urlchecker "+rname+"] ill-formed URL"
-              send_email(smtp_server,recipients,from_mail,entry,subject)
-
-    #connection_failed
-    if len(connection_failed) > 0:
-          for entry in connection_failed:
-              rtype_id=connection_failed.index(entry)
-              try:
-                    rname,recipients=email_info[str(rtype_id)].split("|")
-              except:
-                    continue
-              subject="[urlchecker "+rname+"] connection failed"
-              send_email(smtp_server,recipients,from_mail,entry,subject)
-    #bad_request
-    if len(bad_request) > 0:
-          for entry in bad_request:
-              rtype_id=bad_request.index(entry)
-              try:
-                    rname,recipients=email_info[str(rtype_id)].split("|")
-              except:
-                    continue
-              subject="[urlchecker "+rname+"] bad HTTP request"
-              send_email(smtp_server,recipients,from_mail,entry,subject)
-    #permission_required
-    if len(pass_required) > 0:
-          for entry in pass_required:
-              rtype_id=pass_required.index(entry)
-              try:
-                    rname,recipients=email_info[str(rtype_id)].split("|")
-              except:
-                    continue
-              subject="[urlchecker "+rname+"] permission required"
-              send_email(smtp_server,recipients,from_mail,entry,subject)
-    #forbidden
-    if len(forbidden) > 0:
-          for entry in forbidden:
-              rtype_id=forbidden.index(entry)
-              try:
-                    rname,recipients=email_info[str(rtype_id)].split("|")
-              except:
-                    continue
-              subject="[urlchecker "+rname+"] access forbidden"
-              send_email(smtp_server,recipients,from_mail,entry,subject)
-    #internal_error
-    if len(internal_error) > 0:
-          for entry in internal_error:
-              rtype_id=internal_error.index(entry)
-              try:
-                    rname,recipients=email_info[str(rtype_id)].split("|")
-              except:
-                    continue
-              subject="[urlchecker "+rname+"] system error"
-              send_email(smtp_server,recipients,from_mail,entry,subject)
-    #unsupported_HTTP_protocol
-    if len(unsupported_HTTP_protocol) > 0:
-          for entry in unsupported_HTTP_protocol:
-              rtype_id=unsupported_HTTP_protocol.index(entry)
-              try:
-                    rname,recipients=email_info[str(rtype_id)].split("|")
-              except:
-                    continue
-              subject="[urlchecker "+rname+"] unsupported HTTP protocol"
-              send_email(smtp_server,recipients,from_mail,entry,subject)
-
+  # send emails  with results, through one SMTP session.
+    unsent=0
+    if shard_count > 0:
+       # the merge (--merge) mails the reports of all the shards.
+       results_out.close()
+       os.replace(shard_path+".tmp",shard_path)
+    else:
+       metrics.phase("mail")
+       mailer=Mailer(smtp_server,smtp_timeout)
+       send_reports(mailer,aggregator,email_info,from_mail,mail_digest)
+       mailer.close()
+       unsent=mailer.unsent
+       if baseline is not None:
+          sys.stderr.write("failures unchanged since the last run: "+str(aggregator.unchanged)+
+                           " fixed: "+str(aggregator.fixed)+"\n")
+       if unsent == 0:
+          aggregator.commit()
+       aggregator.close()
+    metrics.phase(None)
+    if reporter_stop is not None:
+       reporter_stop.set()
+    if metrics_file != "":
+       metrics.write_textfile(metrics_file,counters,metrics_hosts)
+    if streaming or large_input:
+       url_lines=dedupe.line_count
+       distinct_urls=dedupe.url_count
+    run_summary=metrics.summary(counters,{"engine":engine,"streaming":streaming,
+                                          "url_lines":url_lines,"distinct_urls":distinct_urls,
+                                          "reports_unsent":unsent})
+    if summary_file == "":
+       summary_file=temp_directory+"run_summary.json"
+    try:
+       with open(summary_file,"w") as summary_f:
+          json.dump(run_summary,summary_f,indent=1)
+          summary_f.write("\n")
+    except OSError as e:
+       sys.stderr.write("**ERR: couldn't write run summary "+summary_file+": "+str(e)+"\n")
+    if unsent > 0:
+       # the reports are not all sent: the input is not done.
+       exit(1)
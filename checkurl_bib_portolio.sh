@@ -2,8 +2,9 @@
 
 ##
 ##  check_bib_portfolio_url.sh reads a designated ALMA CSV file;  
-##    it converts the file to a text file compatible with check_url.py;
-##    and it feeds the text file to the url checker ( check_url.py) .
+##    and it feeds the file to the url checker ( check_url.py), which
+##    reads the CSV format directly (input_format=alma_csv in check_url.cfg)
+##    and tests the URLs while it reads them (streaming=yes).
 ## example of lines from the CSV file:
 # Bibliographic Record,990016345870302486,http://purl.access.gpo.gov/GPO/LPS125131
 # Portfolio,53284293680002486,http://purl.access.gpo.gov/GPO/LPS125131
@@ -30,30 +31,29 @@ do
 done
 
 file=alma_csv_file    #### your alma file here
-# change Bibliographic Record to "1"
-# change Portfolio to "2"
+# check_url.py maps Bibliographic Record to "1" and Portfolio to "2"
+# (resource_type entries in check_url.cfg) and skips repeated lines.
  
   if [ ! -s ${file} ]; then
       echo "alma text file doesn't exist" >&2
       exit 1
   fi
-  cat  ${file}| ${bin_dir}/parse_csv -d","  |\
-  sed 's/\(.*\)_\|_\(.*\)_\|_\(.*\)/\3_\|_\2_\|_\1/g' | sed 's/Bibliographic Record/1/g'|\
-  sed 's/Portfolio/2/g'| sort -u  > ${work_dir}input_all_urls
-
-  if [ -s ${work_dir}/input_all_urls ]; then
-    cat  ${work_dir}input_all_urls |\
-    ${bin_dir}/check_url.py  ${config_dir}check_url.cfg  2> ${work_dir}checkurl_log 
-    status=$?
-
-    if [ ${status} -eq 0 ]; then
-       filename=$(basename ${file})
-       mv  ${file} ${input_dir}done_${filename}     ## rename original alma file.
-    else
-      echo "url checker failed" >&2
-      exit 1
-    fi
+  # a journal left in temp_directory (see check_url.cfg) means that the
+  # last run was interrupted: resume it.
+  temp_dir=$(sed -n 's/^temp_directory=//p' ${config_dir}check_url.cfg | tail -1)
+  resume=""
+  if ls ${temp_dir}journal_* > /dev/null 2>&1; then
+      resume="--resume"
+  fi
+  cat  ${file} |\
+  ${bin_dir}/check_url.py  ${config_dir}check_url.cfg ${resume} 2> ${work_dir}checkurl_log 
+  status=$?
+
+  if [ ${status} -eq 0 ]; then
+     filename=$(basename ${file})
+     mv  ${file} ${input_dir}done_${filename}     ## rename original alma file.
   else
-      echo "conversion from alma format to custom format failed" >&2
+    echo "url checker failed" >&2
+    exit 1
   fi
   exit 0